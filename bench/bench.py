@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# Benchmarks for the plugin against bench/fake_server.py and a headless nvim.
+#
+#   python3 bench/bench.py
+#   python3 bench/bench.py --files 20000 --latency-ms 20 -n 50 ogrok
+#
+# The plugin class is driven directly from here (no rplugin manifest needed),
+# talking to `nvim --embed --headless --clean` over msgpack-rpc, so every
+# nvim request it makes is a real round trip.
+
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import pynvim
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import grokscope
+from fake_server import FakeOpenGrok
+
+
+def percentile(ordered, p):
+    idx = int(round(p / 100.0 * (len(ordered) - 1)))
+    return ordered[idx]
+
+
+def summarize(name, samples, wall):
+    ordered = sorted(samples)
+    return {
+        'scenario' : name,
+        'n'        : len(samples),
+        'ops_s'    : len(samples) / wall if wall > 0 else 0.0,
+        'p50_ms'   : percentile(ordered, 50),
+        'p99_ms'   : percentile(ordered, 99),
+        'max_ms'   : ordered[-1],
+    }
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.tmp = tempfile.mkdtemp(prefix='ogrok-bench-')
+        self.base = os.path.join(self.tmp, 'src')
+        self.server = FakeOpenGrok(files=args.files, hits=args.hits,
+                projects=args.projects, latency_ms=args.latency_ms,
+                jitter_ms=args.jitter_ms).start()
+        self.make_tree()
+        self.nvim = pynvim.attach('child',
+                argv=[args.nvim, '--embed', '--headless', '--clean'])
+        self.plugin = grokscope.OGrokPlugin(self.nvim)
+        self.plugin.OGrokSetServer([self.server.url], '')
+        self.plugin.OGrokSetBasePath([self.base], '')
+
+    def close(self):
+        try:
+            self.nvim.command('qa!')
+        except Exception:
+            # nvim goes away mid request
+            pass
+        self.nvim.close()
+        self.server.stop()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    # a project directory per fake project, plus the first few result files
+    # so jumps land in real files
+    def make_tree(self):
+        for p in range(self.args.projects):
+            os.makedirs(os.path.join(self.base, 'proj{}'.format(p)), exist_ok=True)
+        body = ''.join('line {}\n'.format(i) for i in range(1, 200))
+        for i in range(min(self.args.files, 64)):
+            path = self.base + self.server.path(i)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(body)
+
+    def close_picker(self):
+        # the picker is a float over the work window, which is all we have
+        if len(self.nvim.windows) > 1:
+            self.nvim.command('close')
+
+    def run(self, name, fn):
+        n = self.args.iterations
+        for _ in range(self.args.warmup):
+            fn()
+        samples = []
+        wall = time.perf_counter()
+        for _ in range(n):
+            t = time.perf_counter()
+            fn()
+            samples.append((time.perf_counter() - t) * 1000.0)
+        wall = time.perf_counter() - wall
+        return summarize(name, samples, wall)
+
+    # :OGrok end to end, server round trips through to the rendered picker
+    def scenario_ogrok(self):
+        def fn():
+            self.plugin.OGrok(['def', 'my_symbol'], '')
+            self.close_picker()
+        return self.run('ogrok', fn)
+
+    # :OGrokGoto from an open picker, only the jump is timed
+    def scenario_goto(self):
+        samples = []
+        wall = 0.0
+        for i in range(self.args.warmup + self.args.iterations):
+            self.plugin.OGrok(['def', 'my_symbol', '0', '0'], '')
+            # first result
+            self.nvim.request('nvim_win_set_cursor', 0, (2, 0))
+            t = time.perf_counter()
+            self.plugin.OGrokGoto([], '')
+            dt = time.perf_counter() - t
+            self.nvim.command('enew!')
+            if i >= self.args.warmup:
+                samples.append(dt * 1000.0)
+                wall += dt
+        return summarize('goto', samples, wall)
+
+    # loading and placing signs for a file with lots of notes, from a big db
+    def scenario_annotations(self):
+        db = os.path.join(self.tmp, 'notes.db')
+        target = self.base + self.server.path(0)
+        with open(target, 'w') as f:
+            f.write(''.join('line {}\n'.format(i) for i in range(1, self.args.notes + 2)))
+        target = self.plugin.normalize_path(target)
+
+        self.plugin.OGrokSetAnnotationPath([db], '')
+        # the table is only made on first use
+        self.plugin.ensure_annotations()
+        conn = sqlite3.connect(db)
+        with conn:
+            # the file we open, plus a lot of noise in other files
+            rows = [(target, l, 'note {}'.format(l), '') for l in range(1, self.args.notes + 1)]
+            rows += [('/elsewhere/f{}.c'.format(i // 100), i % 100 + 1, 'x', '')
+                    for i in range(self.args.db_rows)]
+            conn.executemany('INSERT INTO AnnotationTable (file, line, annotation, tags) VALUES (?, ?, ?, ?)', rows)
+        conn.close()
+
+        self.nvim.command('edit {}'.format(target))
+        def fn():
+            # start from a clean slate every time
+            self.nvim.command('sign unplace * buffer={}'.format(self.nvim.current.buffer.number))
+            self.plugin.annotation_ids.clear()
+            self.plugin.OGrokTryGetNotesForFile([], '')
+        ret = self.run('annotations', fn)
+        self.nvim.command('enew!')
+        return ret
+
+    def scenario_project(self):
+        cwd = os.path.join(self.base, 'proj{}'.format(self.args.projects - 1))
+        self.nvim.chdir(cwd)
+        def fn():
+            assert self.plugin.get_current_project() is not None
+        ret = self.run('get_current_project', fn)
+        self.nvim.chdir(self.tmp)
+        return ret
+
+
+SCENARIOS = ['ogrok', 'goto', 'annotations', 'project']
+
+
+def main():
+    p = argparse.ArgumentParser(description='OGrok plugin benchmarks.')
+    p.add_argument('scenarios', nargs='*',
+            help='scenarios to run, any of {} (default: all)'.format(', '.join(SCENARIOS)))
+    p.add_argument('-n', '--iterations', type=int, default=20)
+    p.add_argument('--warmup', type=int, default=2)
+    p.add_argument('--nvim', default='nvim')
+    p.add_argument('--files', type=int, default=2000,
+            help='documents matching each query')
+    p.add_argument('--hits', type=int, default=3, help='hits per document')
+    p.add_argument('--projects', type=int, default=64)
+    p.add_argument('--latency-ms', type=float, default=5.0)
+    p.add_argument('--jitter-ms', type=float, default=0.0)
+    p.add_argument('--notes', type=int, default=5000,
+            help='annotations in the opened file')
+    p.add_argument('--db-rows', type=int, default=200000,
+            help='annotations on other files')
+    p.add_argument('--json', action='store_true', help='one json object per scenario')
+    a = p.parse_args()
+    for name in a.scenarios:
+        if name not in SCENARIOS:
+            p.error('unknown scenario {}'.format(name))
+
+    b = Bench(a)
+    results = []
+    try:
+        for name in (a.scenarios or SCENARIOS):
+            results.append(getattr(b, 'scenario_' + name)())
+    finally:
+        stats = b.plugin.stats.report()
+        requests, sent = b.server.requests, b.server.bytes_sent
+        b.close()
+
+    if a.json:
+        for r in results:
+            print(json.dumps(r))
+        return
+
+    print('{:<20} {:>5} {:>9} {:>9} {:>9} {:>9}'.format(
+        'scenario', 'n', 'ops/s', 'p50 ms', 'p99 ms', 'max ms'))
+    for r in results:
+        print('{scenario:<20} {n:>5} {ops_s:>9.1f} {p50_ms:>9.2f} {p99_ms:>9.2f} {max_ms:>9.2f}'.format(**r))
+    print()
+    print('server: {} requests, {:.1f} MB sent'.format(requests, sent / 1e6))
+    print()
+    print('\n'.join(stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# A stand-in for an OpenGrok server. Only implements /api/v1/search, which is
+# all the plugin uses, with a configurable number of results, pagination and
+# injected latency.
+#
+#   python3 bench/fake_server.py --files 20000 --latency-ms 30
+#   :OGrokSetServer http://localhost:8089/source
+
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOpenGrok:
+    # files: how many documents match any query (resultCount)
+    # hits: lines per document
+    # projects: results are spread over proj0..projN-1
+    # latency_ms/jitter_ms: sleep this long before answering each request
+    # fail_rate: fraction of requests answered with a 500
+    def __init__(self, port=0, prefix='/source', files=1000, hits=3,
+            projects=8, latency_ms=0.0, jitter_ms=0.0, fail_rate=0.0):
+        self.prefix = prefix.rstrip('/')
+        self.files = files
+        self.hits = hits
+        self.projects = projects
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.fail_rate = fail_rate
+        # number of requests served, handy for checking paging behaviour
+        self.requests = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+
+        fake = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}{}'.format(self.port, self.prefix)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    # every file in the fake index. Paths look like OpenGrok's, i.e. they start
+    # with /<project>/
+    def path(self, i):
+        return '/proj{}/dir{}/file{}.c'.format(i % self.projects, i % 17, i)
+
+    def results(self, term, start, count, proj):
+        ret = {}
+        idxs = range(self.files)
+        if proj:
+            idxs = [i for i in idxs if 'proj{}'.format(i % self.projects) == proj]
+        for i in list(idxs)[start:start + count]:
+            ret[self.path(i)] = [{
+                # OpenGrok hands back line numbers as strings
+                'line'       : '    int x = <b>{}</b>(a, b); /* {} */'.format(term, h),
+                'lineNumber' : str(10 * (h + 1)),
+                'tag'        : None,
+            } for h in range(self.hits)]
+        total = len(idxs) if proj else self.files
+        return total, ret
+
+    def handle(self, req):
+        url = urllib.parse.urlsplit(req.path)
+        with self.lock:
+            self.requests += 1
+
+        if url.path != self.prefix + '/api/v1/search':
+            req.send_error(404)
+            return
+
+        delay = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+
+        if self.fail_rate and random.random() < self.fail_rate:
+            req.send_error(500)
+            return
+
+        q = urllib.parse.parse_qs(url.query)
+        term = ''
+        for key in ('def', 'symbol', 'path', 'full'):
+            if key in q:
+                term = q[key][0].strip('*')
+                break
+        count = int(q.get('maxresults', ['25'])[0])
+        start = int(q.get('start', ['0'])[0])
+        proj = q.get('projects', [None])[0]
+
+        t = time.perf_counter()
+        total, results = self.results(term, start, count, proj)
+        body = json.dumps({
+            'time'          : int((time.perf_counter() - t) * 1000),
+            'resultCount'   : total,
+            'startDocument' : start,
+            'endDocument'   : start + len(results) - 1,
+            'results'       : results,
+        }).encode()
+
+        req.send_response(200)
+        req.send_header('Content-Type', 'application/json')
+        req.send_header('Content-Length', str(len(body)))
+        req.end_headers()
+        req.wfile.write(body)
+        with self.lock:
+            self.bytes_sent += len(body)
+
+
+def main():
+    p = argparse.ArgumentParser(description='Fake OpenGrok search API.')
+    p.add_argument('--port', type=int, default=8089)
+    p.add_argument('--prefix', default='/source')
+    p.add_argument('--files', type=int, default=1000)
+    p.add_argument('--hits', type=int, default=3)
+    p.add_argument('--projects', type=int, default=8)
+    p.add_argument('--latency-ms', type=float, default=0.0)
+    p.add_argument('--jitter-ms', type=float, default=0.0)
+    p.add_argument('--fail-rate', type=float, default=0.0)
+    a = p.parse_args()
+
+    server = FakeOpenGrok(a.port, a.prefix, a.files, a.hits, a.projects,
+            a.latency_ms, a.jitter_ms, a.fail_rate)
+    print('serving {} on {}'.format(server.url, server.port))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# What the plugin costs at nvim startup: importing grokscope in a fresh
+# interpreter, and running the README's VimEnter setup commands.
+#
+#   python3 bench/startup.py
+#   git show <rev>:grokscope.py > /tmp/old.py
+#   python3 bench/startup.py --plugin /tmp/old.py     # compare
+#
+# The setup part needs nvim on the path, --no-nvim skips it.
+
+import argparse
+import importlib.util
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+from fake_server import FakeOpenGrok
+
+# pynvim is already loaded in the plugin host by the time our module is
+# imported, so only count what comes after it
+IMPORT_SNIPPET = '''
+import importlib.util, sys, time
+import pynvim
+t = time.perf_counter()
+spec = importlib.util.spec_from_file_location('grokscope', sys.argv[1])
+mod = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(mod)
+print((time.perf_counter() - t) * 1000.0)
+'''
+
+
+def load_plugin(path):
+    spec = importlib.util.spec_from_file_location('grokscope', path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def summary(name, samples):
+    samples = sorted(samples)
+    return '{:<28} n={:<4} median {:>8.2f} ms   min {:>8.2f} ms   max {:>8.2f} ms'.format(
+        name, len(samples), statistics.median(samples), samples[0], samples[-1])
+
+
+def bench_import(plugin, n):
+    # compile once so every run sees a .pyc, like a normal startup
+    subprocess.run([sys.executable, '-c', IMPORT_SNIPPET, plugin],
+            check=True, capture_output=True)
+    samples = []
+    for _ in range(n):
+        out = subprocess.run([sys.executable, '-c', IMPORT_SNIPPET, plugin],
+                check=True, capture_output=True, text=True)
+        samples.append(float(out.stdout.strip()))
+    return samples
+
+
+def bench_setup(plugin, n, nvim_bin, latency_ms):
+    import pynvim
+    mod = load_plugin(plugin)
+    server = FakeOpenGrok(latency_ms=latency_ms).start()
+    tmp = tempfile.mkdtemp(prefix='ogrok-startup-')
+    samples = []
+    try:
+        for i in range(n):
+            nvim = pynvim.attach('child', argv=[nvim_bin, '--embed', '--headless', '--clean'])
+            try:
+                t = time.perf_counter()
+                p = mod.OGrokPlugin(nvim)
+                p.OGrokSetServer([server.url, '1'], '')
+                p.OGrokSetBasePath([tmp], '')
+                p.OGrokSetAnnotationPath([os.path.join(tmp, 'notes{}.db'.format(i))], '')
+                samples.append((time.perf_counter() - t) * 1000.0)
+            finally:
+                try:
+                    nvim.command('qa!')
+                except Exception:
+                    pass
+                nvim.close()
+    finally:
+        server.stop()
+        shutil.rmtree(tmp, ignore_errors=True)
+    return samples
+
+
+def main():
+    p = argparse.ArgumentParser(description='OGrok plugin startup cost.')
+    p.add_argument('--plugin', default=os.path.join(os.path.dirname(HERE), 'grokscope.py'))
+    p.add_argument('-n', '--iterations', type=int, default=20)
+    p.add_argument('--nvim', default='nvim')
+    p.add_argument('--no-nvim', action='store_true', help='only time the import')
+    p.add_argument('--latency-ms', type=float, default=200.0,
+            help='server latency, what the test=1 probe has to wait for')
+    a = p.parse_args()
+
+    print(summary('import', bench_import(a.plugin, a.iterations)))
+    if not a.no_nvim:
+        print(summary('VimEnter setup commands',
+            bench_setup(a.plugin, a.iterations, a.nvim, a.latency_ms)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,31 @@
+# Keep this list short, it's paid on every nvim start. requests, sqlite3 and
+# logging.handlers are imported where they're first used. (logging,
+# threading and concurrent.futures are already loaded by pynvim.)
 import pynvim
-import requests
 import warnings
 import os
-import sqlite3
+import json
+import time
+import collections
+import contextlib
+import logging
+import queue
+import concurrent.futures
+import re
+import threading
+import mmap
+import stat
+import array
+import html
 
 class Location:
-    def __init__(self, path, line_content, line_num):
+    # base is the local base path for results from a server other than the
+    # main one (see OGrokAddServer)
+    def __init__(self, path, line_content, line_num, base=None):
         self.path = path
         self.content = line_content
         self.line_num = line_num
+        self.base = base
 
     def __str__(self):
         return '{}:{}\n  {}'.format(self.path, self.line_num, self.content.strip())
@@ -23,6 +40,29 @@ class Location:
     def truncated_str(self):
         return '{}:{}\n  {}'.format(self.truncated_path(), self.line_num, self.content.strip())
 
+    # what to look for in the local file to check the line number is still
+    # right: the whole line, and the highlighted term in it
+    def snippet_needles(self):
+        focus = ''
+        start = self.content.find('<b>')
+        if start != -1:
+            end = self.content.find('</b>', start)
+            if end != -1:
+                focus = html.unescape(self.content[start + 3:end])
+        needle = html.unescape(self.content.replace('<b>', '').replace('</b>', ''))
+        return needle.strip(), focus
+
+    # the server hands back html-ish snippets
+    def clean_content(self):
+        # XXX do this properly
+        return self.content.strip().replace('<b>', "")\
+                .replace('</b>', "")\
+                .replace('\n', 'XXXX')\
+                .replace('\r', 'YYYY')\
+                .replace("&gt;", ">")\
+                .replace("&lt;", "<")\
+                .replace("&amp;", "&")
+
     def from_ogrok_dict(d):
         ret = []
         for path in d:
@@ -38,6 +78,9 @@ class Location:
         return ret
 
 class Mark:
+    # there can be a lot of these sitting around
+    __slots__ = ('path', 'line', 'col')
+
     def __init__(self, path, line_number, col):
         self.path = path
         self.line = line_number
@@ -57,74 +100,581 @@ class Mark:
 
         return f'Mark({path}:{self.line}|{self.col})'
 
+    __repr__ = __str__
+
+# OGrok's query types, 0: def, 1: file, 2: sym
+_QUERY_TYPES = {
+    'g': 0, 'd': 0, 'def': 0,
+    'f': 1, 'file': 1, 'path': 1,
+    's': 2, 'sym': 2,
+}
+# server side key for each query type
+_QUERY_KEYS = ['def', 'path', 'symbol']
+
+# plain strings, re compiles (and caches) them the first time they're used
+_IDENT_RE = r'[A-Za-z_][A-Za-z0-9_]*'
+# not worth asking the server about
+_BATCH_SKIP = set('''
+    if else for while do switch case default break continue return goto
+    sizeof typedef struct union enum const static extern volatile inline
+    void char short int long float double signed unsigned bool true false
+    auto register NULL nullptr new delete this class public private
+    protected template typename namespace using def import from in is not
+    and or None True False self lambda pass with as try except finally
+    raise yield
+'''.split())
+
+# last line of the lazy picker while there are more pages to get
+_LAZY_TAIL = '~~ more results load as you scroll ~~'
+
+# jump to a file and position in one request. fnameescape deals with spaces and
+# friends in the path, and we don't blow up if the file got shorter. A
+# negative col means the first non-blank.
+_JUMP_LUA = '''
+local path, line, col = ...
+vim.cmd('edit ' .. vim.fn.fnameescape(path))
+line = math.max(1, math.min(line, vim.api.nvim_buf_line_count(0)))
+vim.api.nvim_win_set_cursor(0, {line, math.max(col, 0)})
+if col < 0 then
+    vim.cmd('normal! ^')
+end
+'''
+
+# end of line markers on picker lines, one request for all of them
+_NOTES_LUA = '''
+local buf, ns, marks = ...
+for _, m in ipairs(marks) do
+    vim.api.nvim_buf_set_extmark(buf, ns, m[1], 0, {
+        virt_text = {{m[2], 'Todo'}}, virt_text_pos = 'eol'})
+end
+'''
+
+
+class LineIndex:
+    # Where each line starts in local files, so we can look at a line without
+    # reading the whole file. Kept for the last `size` files and rebuilt when
+    # a file's mtime or size changes. Used to catch the server's line numbers
+    # being out of date with the local checkout.
+    def __init__(self, size=64):
+        self.size = size
+        # path -> ((mtime, size), array of line start offsets)
+        self.cache = collections.OrderedDict()
+
+    def offsets(self, path, mm, key):
+        hit = self.cache.get(path)
+        if hit and hit[0] == key:
+            self.cache.move_to_end(path)
+            return hit[1]
+        offsets = array.array('Q', [0])
+        pos = mm.find(b'\n')
+        while pos != -1:
+            offsets.append(pos + 1)
+            pos = mm.find(b'\n', pos + 1)
+        self.cache[path] = (key, offsets)
+        while len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+        return offsets
+
+    # The line closest to `line` (1 indexed) that contains `needle`, checking
+    # `line` itself first, then one either side, two either side, ... up to
+    # `radius`. Returns (line, byte column of `focus` in it) or None.
+    def find(self, path, line, needle, focus='', radius=2000):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if st.st_size == 0:
+            return None
+        with open(path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offsets = self.offsets(path, mm, (st.st_mtime_ns, st.st_size))
+            nlines = len(offsets)
+
+            def raw(n):
+                end = offsets[n] if n < nlines else len(mm)
+                return mm[offsets[n - 1]:end]
+
+            for d in range(radius + 1):
+                for n in ((line,) if d == 0 else (line - d, line + d)):
+                    if n < 1 or n > nlines:
+                        continue
+                    r = raw(n)
+                    if needle in r.decode('utf-8', 'replace'):
+                        # nvim wants a byte column
+                        col = r.find(focus.encode('utf-8')) if focus else -1
+                        return n, col
+                if line - d < 1 and line + d > nlines:
+                    break
+        return None
+
+
+class SearchHistory:
+    # the last N queries along with their results, compacted down to
+    # (filename, line, text) so we can hand them to the quickfix list later
+    # without asking the server again.
+    def __init__(self, size=20):
+        self.entries = collections.deque(maxlen=size)
+        # optional json file so history survives a restart
+        self.file = None
+
+    def resize(self, size):
+        self.entries = collections.deque(self.entries, maxlen=size)
+
+    def add(self, kind, query, fuzzy, proj_name, items):
+        self.entries.append({
+            'kind'  : kind,
+            'query' : query,
+            'fuzzy' : fuzzy,
+            'proj'  : proj_name,
+            'time'  : time.time(),
+            'items' : items,
+        })
+        return self.entries[-1]
+
+    # 0 is the most recent search
+    def get(self, idx):
+        if idx < 0 or idx >= len(self.entries):
+            return None
+        return self.entries[-1 - idx]
+
+    def title(self, entry):
+        title = 'OGrok {} {}'.format(entry['kind'], entry['query'])
+        if entry['proj']:
+            title += ' ({})'.format(entry['proj'])
+        return title
+
+    def load(self, fname):
+        self.file = fname
+        if not os.path.exists(fname):
+            return
+        with open(fname, 'r') as f:
+            entries = json.load(f)
+        self.entries = collections.deque(entries, maxlen=self.entries.maxlen)
+
+    def save(self):
+        if not self.file:
+            return
+        # write then rename so a crash doesn't leave half a file behind
+        tmp = self.file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(list(self.entries), f, separators=(',', ':'))
+        os.replace(tmp, self.file)
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record):
+        d = {
+            't'     : round(record.created, 3),
+            'level' : record.levelname.lower(),
+            'event' : record.getMessage(),
+        }
+        d.update(getattr(record, 'fields', {}))
+        return json.dumps(d, separators=(',', ':'), default=str)
+
+
+class _DroppingQueue(queue.Queue):
+    # never block the ui thread on logging. If the writer can't keep up we'd
+    # rather lose records than stall the editor. (QueueHandler uses
+    # put_nowait.)
+    def __init__(self, maxsize):
+        super().__init__(maxsize)
+        self.dropped = 0
+
+    def put_nowait(self, item):
+        if item is None:
+            # QueueListener.stop's sentinel (QueueHandler only sends records).
+            # If that's dropped the listener never exits and stop() hangs, so
+            # wait for the room.
+            self.put(item)
+            return
+        try:
+            super().put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+
+class StructuredLog:
+    # json lines written by a background thread, rotated by size
+    LEVELS = {
+        'debug'   : logging.DEBUG,
+        'info'    : logging.INFO,
+        'warning' : logging.WARNING,
+        'error'   : logging.ERROR,
+    }
+
+    def __init__(self):
+        self.logger = logging.getLogger('ogrok')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.path = None
+        self.handler = None
+        self.listener = None
+
+    def open(self, path, max_bytes=10*1024*1024, backups=3):
+        import logging.handlers
+        self.close()
+        fh = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backups, delay=True)
+        fh.setFormatter(_JsonFormatter())
+        self.handler = logging.handlers.QueueHandler(_DroppingQueue(10000))
+        self.listener = logging.handlers.QueueListener(self.handler.queue, fh)
+        self.listener.start()
+        self.logger.addHandler(self.handler)
+        self.path = path
+
+    def close(self):
+        if self.listener:
+            self.logger.removeHandler(self.handler)
+            # flushes whatever is still queued
+            self.listener.stop()
+            for h in self.listener.handlers:
+                h.close()
+        self.path = None
+        self.handler = None
+        self.listener = None
+
+    def set_level(self, name):
+        if name not in StructuredLog.LEVELS:
+            raise Exception('Unknown log level {}. Options are {}'.format(
+                name, '|'.join(StructuredLog.LEVELS)))
+        self.logger.setLevel(StructuredLog.LEVELS[name])
+
+    def enabled(self, level):
+        return self.handler is not None and self.logger.isEnabledFor(level)
+
+    def _log(self, level, event, fields):
+        if self.enabled(level):
+            self.logger.log(level, event, extra={'fields': fields})
+
+    def debug(self, event, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self._log(logging.INFO, event, fields)
+
+    def error(self, event, **fields):
+        self._log(logging.ERROR, event, fields)
+
+
+class SearchBatch:
+    # one page of results from OpenGrokAPI.iter_search
+    __slots__ = ('locations', 'start', 'files', 'total', 'done')
+
+    def __init__(self, locations, start, files, total, done):
+        self.locations = locations
+        # document offset this page started at
+        self.start = start
+        # documents fetched so far, including this page
+        self.files = files
+        # documents the server says match
+        self.total = total
+        # last batch we'll yield
+        self.done = done
+
+    # the search stopped before the server ran out of results
+    @property
+    def partial(self):
+        return self.done and self.files < self.total
+
+
+class PickerSession:
+    # state for one open picker, see OGrokPlugin.pickers
+    __slots__ = ('locations', 'work_buffer', 'work_window', 'row', 'col',
+            'query_type', 'history_entry', 'feed', 'loading')
+
+    def __init__(self, locations, work_buffer, work_window, row, col,
+            query_type, history_entry, feed=None):
+        self.locations = locations
+        # where the user was when they searched, to go back to (and push on
+        # the jump stack) when they pick a result
+        self.work_buffer = work_buffer
+        self.work_window = work_window
+        self.row = row
+        self.col = col
+        self.query_type = query_type
+        # in the search history, gets the lazy picker's later pages too
+        self.history_entry = history_entry
+        # lazy picker: generator for the rest of the pages, and whether a
+        # page is being fetched right now
+        self.feed = feed
+        self.loading = False
+
+
+class LatencyStats:
+    # keeps the last `window` timings (in ms) for each named step so we can
+    # tell where a slow search spent its time. See OGrokStats.
+    def __init__(self, window=500):
+        self.window = window
+        # name -> deque of ms
+        self.samples = {}
+        # name -> total number of samples ever taken
+        self.counts = {}
+        # optional StructuredLog, each sample is logged at debug level
+        self.log = None
+
+    @contextlib.contextmanager
+    def timed(self, name, **extra):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - start) * 1000.0, **extra)
+
+    def add(self, name, ms, **extra):
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = collections.deque(maxlen=self.window)
+            self.samples[name] = samples
+            self.counts[name] = 0
+        samples.append(ms)
+        self.counts[name] += 1
+
+        if self.log:
+            self.log.debug('timing', step=name, ms=round(ms, 3), **extra)
+
+    def reset(self):
+        self.samples = {}
+        self.counts = {}
+
+    # nearest rank on an already sorted list
+    def percentile(sorted_samples, p):
+        idx = int(round(p / 100.0 * (len(sorted_samples) - 1)))
+        return sorted_samples[idx]
+
+    def report(self):
+        out = ['{:<18} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+            'step', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')]
+        for name in sorted(self.samples):
+            ordered = sorted(self.samples[name])
+            if len(ordered) == 0:
+                continue
+            out.append('{:<18} {:>7} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+                name, self.counts[name],
+                LatencyStats.percentile(ordered, 50),
+                LatencyStats.percentile(ordered, 90),
+                LatencyStats.percentile(ordered, 99),
+                ordered[-1]))
+        return out
+
+
+class ServerUnavailable(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # Stops us from waiting on a server that is down. After `threshold`
+    # failures in a row the breaker opens and requests fail straight away.
+    # Once the backoff is up one request is let through (half open); if it
+    # works we're back to normal, if not we back off twice as long.
+    def __init__(self, threshold=3, backoff=2.0, max_backoff=120.0):
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.state = 'closed'
+        # consecutive failures
+        self.failures = 0
+        # times opened without a success in between, for the backoff
+        self.trips = 0
+        self.retry_at = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() >= self.retry_at:
+                # this caller is the probe, everyone else keeps failing fast
+                self.state = 'half-open'
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+            self.trips = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half-open' or self.failures >= self.threshold:
+                self.trips += 1
+                delay = min(self.max_backoff, self.backoff * 2**(self.trips - 1))
+                self.state = 'open'
+                self.retry_at = time.monotonic() + delay
+
+    def describe(self):
+        if self.state == 'open':
+            wait = max(0, self.retry_at - time.monotonic())
+            return 'open after {} failures, retrying in {:.0f}s'.format(self.failures, wait)
+        if self.state == 'half-open':
+            return 'half-open, probing'
+        if self.failures:
+            return 'closed, {} recent failures'.format(self.failures)
+        return 'closed'
+
 
 class OpenGrokAPI:
 
     # addr is the location you'd go in a web browser
     # e.g., http://localhost:8080/source
-    def __init__(self, addr, test=False):
-        self.session = requests.Session()
+    def __init__(self, addr, test=False, stats=None):
+        # made on first use, see session
+        self._session = None
+        self._session_lock = threading.Lock()
         self.addr = '{}/api/v1/'.format(addr)
+        self.stats = stats if stats else LatencyStats()
+        # seconds, per request
+        self.timeout = 5
+        self.breaker = CircuitBreaker()
+        # the last few pages we got, keyed by request, to fall back on while
+        # the breaker is open
+        self.cache = collections.OrderedDict()
+        self.cache_size = 16
+        # searches come in from several threads at once (batch and call
+        # tree pools, federated search, lazy picker)
+        self.cache_lock = threading.Lock()
         if test:
-            try:
-                rsp = self.session.get(
-                    self.addr + 'search?def=lkjsadadfkj&maxresults=1',
-                    timeout=3,
-                )
-                if not rsp.ok:
-                    errmsg  = "OGrok: Host {} did not respond OK: {}"
-                    raise Exception(errmsg.format(self.addr, rsp))
-            except Exception as e:
-                errmsg  = "OGrok: Failed to connect to {}: {}"
-                raise Exception(errmsg.format(self.addr, e))
+            self.probe()
+
+    # importing requests and setting up a session isn't free, so it waits
+    # until the first request
+    @property
+    def session(self):
+        with self._session_lock:
+            if self._session is None:
+                import requests
+                self._session = requests.Session()
+            return self._session
+
+    # raises if the server isn't there
+    def probe(self):
+        try:
+            rsp = self.session.get(
+                self.addr + 'search?def=lkjsadadfkj&maxresults=1',
+                timeout=3,
+            )
+            if not rsp.ok:
+                errmsg  = "OGrok: Host {} did not respond OK: {}"
+                raise Exception(errmsg.format(self.addr, rsp))
+        except Exception as e:
+            errmsg  = "OGrok: Failed to connect to {}: {}"
+            raise Exception(errmsg.format(self.addr, e))
 
 
 
 
     # TODO URL Encode stuff. stuff can have non-url path stuff in it? Or does requests handle that already..?
-    def _search(self, key, s, count, fuzzy, proj_name):
+    # yields (start, response dict) one page at a time, `count` documents per
+    # page, until the server runs out.
+    def _pages(self, key, s, count, fuzzy, proj_name):
         if fuzzy:
             s = '*{}*'.format(s)
-        get_all = False
-        if count == -1:
-            # get all, 1000 at a time
-            get_all = True
-            count = 1000
-        req = ""
         if proj_name:
             reqfmt = self.addr + 'search?' + key + '={symbol}&maxresults={count}&start={idx}&projects={proj}'
-            req = reqfmt.format(symbol=s, count=count, idx=0, proj=proj_name)
         else:
             reqfmt = self.addr + 'search?' + key + '={symbol}&maxresults={count}&start={idx}'
-            req = reqfmt.format(symbol=s, count=count, idx=0)
 
-        rsp = self.session.get(req, timeout=5)
+        start = 0
+        while True:
+            req = reqfmt.format(symbol=s, count=count, idx=start, proj=proj_name)
+            d = self._get(req, start)
+            yield start, d
+
+            start += len(d['results'])
+            if len(d['results']) == 0 or start >= d['resultCount']:
+                return
+
+    # one search request through the circuit breaker
+    def _get(self, req, start=0):
+        import requests
+        if not self.breaker.allow():
+            with self.cache_lock:
+                d = self.cache.get(req)
+            if d is not None:
+                self.stats.add('search.cached', 0.0)
+                return d
+            raise ServerUnavailable('Server {} unavailable (breaker {})'.format(
+                self.addr, self.breaker.describe()))
+
+        try:
+            with self.stats.timed('search.page', start=start):
+                rsp = self.session.get(req, timeout=self.timeout)
+        except requests.RequestException:
+            # timeouts, refused connections, ...
+            self.breaker.failure()
+            raise
+        if rsp.status_code >= 500:
+            self.breaker.failure()
+            raise Exception("Request '{}' failed ({}).".format(req,rsp))
+        # a 4xx still means the server is up
+        self.breaker.success()
         if not rsp.ok:
             raise Exception("Request '{}' failed ({}).".format(req,rsp))
-        d = rsp.json()
-        ret = d['results']
-        if not get_all:
-            return ret
-
-        total = d['resultCount']
-        times = 1
-        while len(ret) < total:
-            req = reqfmt.format(symbol=s, count=count, idx=len(ret))
-            rsp = self.session.get(req)
-            if not rsp.ok:
-                raise Exception("Request '{}' failed ({}).".format(req,rsp))
+        with self.stats.timed('search.decode', size=len(rsp.content)):
             d = rsp.json()
-            total = d['resultCount']
+
+        with self.cache_lock:
+            self.cache[req] = d
+            self.cache.move_to_end(req)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return d
+
+    def _search(self, key, s, count, fuzzy, proj_name):
+        get_all = False
+        if count == -1:
+            # get all, 1000 at a time
+            get_all = True
+            count = 1000
+
+        ret = {}
+        times = 0
+        for start, d in self._pages(key, s, count, fuzzy, proj_name):
             ret.update(d['results'])
+            if not get_all:
+                break
 
             times += 1
             if times > 10:
                 # TODO replace this with normal error handling...
                 # Maybe make the pop up window just say "partial results" or something
+                # (see iter_search)
                 warnings.warn("Server claims too many results. Returning early.")
                 break
         return ret
 
+    # Like _search but hands back a SearchBatch of Locations per page instead
+    # of collecting everything. Only one page is held at a time, and there's
+    # no page cap, so stop early by breaking out of the loop or with `limit`
+    # (number of hits). key is one of def|symbol|path.
+    def iter_search(self, key, s, fuzzy=False, proj_name=None, page_size=1000, limit=None):
+        files = 0
+        hits = 0
+        for start, d in self._pages(key, s, page_size, fuzzy, proj_name):
+            with self.stats.timed('from_ogrok_dict'):
+                locations = Location.from_ogrok_dict(d['results'])
+            total = d['resultCount']
+            if limit and hits + len(locations) > limit:
+                # keep only what's left of the limit. Locations are grouped
+                # by file, so only the first one we drop can be cut into.
+                # It and the ones after it don't count as fetched, which
+                # keeps the batch partial.
+                cut = limit - hits
+                whole = set(l.path for l in locations[:cut]) - {locations[cut].path}
+                files += len(whole)
+                locations = locations[:cut]
+            else:
+                files += len(d['results'])
+            hits += len(locations)
+
+            done = len(d['results']) == 0 or files >= total
+            if limit and hits >= limit:
+                done = True
+            yield SearchBatch(locations, start, files, total, done)
+            if done:
+                return
+
     def search_symbol(self, s, count=-1, fuzzy=False, proj_name=None):
         return self._search('symbol', s, count, fuzzy, proj_name)
 
@@ -134,8 +684,6 @@ class OpenGrokAPI:
     def search_path(self, s, count=-1, fuzzy=False, proj_name=None):
         return self._search('path', s, count, fuzzy, proj_name)
 
-import threading
-import time
 class KeepaliveThread(threading.Thread):
     def __init__(self, keepalive, api):
         super().__init__()
@@ -157,8 +705,433 @@ class KeepaliveThread(threading.Thread):
             timer.join()
 
 
+# The annotation db can be shared by a team (e.g. on a network drive), so
+# every write also goes into AnnotationLog through these triggers. Editors
+# poll the log for what changed since they last looked instead of reloading
+# everything. The log only keeps the last _ANNOTATION_LOG_KEEP changes.
+_ANNOTATION_LOG_KEEP = 10000
+_ANNOTATION_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS AnnotationTable(file, line, annotation, tags)",
+    "CREATE INDEX IF NOT EXISTS AnnotationFileLine ON AnnotationTable(file, line)",
+    "CREATE TABLE IF NOT EXISTS AnnotationLog(seq INTEGER PRIMARY KEY AUTOINCREMENT, file, line)",
+    '''CREATE TRIGGER IF NOT EXISTS AnnotationLogInsert AFTER INSERT ON AnnotationTable BEGIN
+        INSERT INTO AnnotationLog(file, line) VALUES (NEW.file, NEW.line);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS AnnotationLogUpdate AFTER UPDATE ON AnnotationTable BEGIN
+        INSERT INTO AnnotationLog(file, line) VALUES (OLD.file, OLD.line);
+        INSERT INTO AnnotationLog(file, line) SELECT NEW.file, NEW.line
+            WHERE NEW.file IS NOT OLD.file OR NEW.line IS NOT OLD.line;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS AnnotationLogDelete AFTER DELETE ON AnnotationTable BEGIN
+        INSERT INTO AnnotationLog(file, line) VALUES (OLD.file, OLD.line);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS AnnotationLogPrune AFTER INSERT ON AnnotationLog BEGIN
+        DELETE FROM AnnotationLog WHERE seq <= NEW.seq - {};
+    END'''.format(_ANNOTATION_LOG_KEEP),
+]
+
+
+def _rewrite_prefix(path, old, new):
+    if path.startswith(old):
+        return new + path[len(old):]
+    return path
+
+
+class AnnotationWatcher(threading.Thread):
+    # Looks for other editors' changes to the annotation db every `interval`
+    # seconds. PRAGMA data_version only changes when another connection has
+    # committed, so most polls are one cheap query. Changes go to `callback`
+    # (from this thread) as a list of
+    #    (file, line, note, tags)     note and tags are None if deleted
+    # or None if we fell behind the log and everything should be reloaded.
+    def __init__(self, db, seq, interval, timeout, callback):
+        super().__init__(daemon=True)
+        self.db = db
+        self.seq = seq
+        self.interval = interval
+        self.timeout = timeout
+        self.callback = callback
+        self.shutdown_flag = threading.Event()
+
+    def stop(self):
+        self.shutdown_flag.set()
+
+    def run(self):
+        import sqlite3
+        # we handle the transactions
+        conn = sqlite3.connect(self.db, timeout=self.timeout, isolation_level=None)
+        try:
+            version = None
+            while not self.shutdown_flag.wait(self.interval):
+                try:
+                    v = conn.execute('PRAGMA data_version').fetchone()[0]
+                    if v == version:
+                        continue
+                    version = v
+                    changes = self.poll(conn)
+                except sqlite3.Error:
+                    # locked for longer than the timeout, or the file went
+                    # away for a bit. Try again next time
+                    if conn.in_transaction:
+                        conn.execute('ROLLBACK')
+                    version = None
+                    continue
+                if changes is None or len(changes) > 0:
+                    self.callback(changes)
+        finally:
+            conn.close()
+
+    def poll(self, conn):
+        # one read transaction so the log and the notes agree
+        conn.execute('BEGIN')
+        try:
+            lo, hi = conn.execute('SELECT MIN(seq), MAX(seq) FROM AnnotationLog').fetchone()
+            if hi is None or hi <= self.seq:
+                return []
+            if lo > self.seq + 1:
+                # what we missed has been pruned
+                self.seq = hi
+                return None
+            rows = conn.execute('''
+                SELECT c.file, c.line, a.annotation, a.tags
+                FROM (SELECT DISTINCT file, line FROM AnnotationLog WHERE seq > ?) c
+                LEFT JOIN AnnotationTable a ON a.file = c.file AND a.line = c.line
+            ''', (self.seq,)).fetchall()
+            self.seq = hi
+            return rows
+        finally:
+            conn.execute('COMMIT')
+
+
+
+
+
+# lines that start a function definition, for finding the function a
+# reference is in. Heuristic: C-ish definitions start at column 0, plus
+# python's def and go's func.
+_FUNC_DEF_RES = [
+    r'^\s*(?:async\s+)?def\s+([A-Za-z_]\w*)\s*\(',
+    r'^func\s+(?:\([^)]*\)\s*)?([A-Za-z_]\w*)\s*\(',
+    r'^(?!(?:if|for|while|switch|return|else|do)\b)(?:[A-Za-z_][\w\s\*&:<>,~]*?\s[\*&]*)?([A-Za-z_][\w:~]*)\s*\([^;]*$',
+]
+
+
+class CallTree:
+    # Who calls `root`, breadth first. For every symbol we ask the server for
+    # its definition and its references, then work out which function each
+    # reference is in by reading the local file. Those functions are the
+    # next level. Each symbol is only looked up once (memo) and we stop
+    # after `budget` symbols.
+    def __init__(self, api, local_path, root, budget=200, limit=1000, files_size=64):
+        self.api = api
+        self.local_path = local_path
+        self.root = root
+        self.budget = budget
+        self.limit = limit
+        # symbol -> (defs, callers). defs is [(file, line)], callers is
+        # [(caller symbol or None, file, line)]
+        self.memo = {}
+        # symbol -> why its lookup failed. Still in memo (with no callers) so
+        # it isn't looked up again and counts against the budget.
+        self.errors = {}
+        # file -> lines for the last `files_size` files, shared by everything
+        # we look at. References to the same symbol tend to be in the same few
+        # files, so that's enough to avoid rereading them.
+        self.files_size = files_size
+        self.files = collections.OrderedDict()
+        self.files_lock = threading.Lock()
+
+    def lines(self, fname):
+        with self.files_lock:
+            if fname in self.files:
+                self.files.move_to_end(fname)
+                return self.files[fname]
+        try:
+            with open(fname, 'r', errors='replace') as f:
+                lines = f.read().split('\n')
+        except OSError:
+            lines = None
+        with self.files_lock:
+            self.files[fname] = lines
+            while len(self.files) > self.files_size:
+                self.files.popitem(last=False)
+        return lines
+
+    # name of the function around line (1 indexed), or None
+    def enclosing(self, fname, line):
+        lines = self.lines(fname)
+        if not lines:
+            return None
+        for i in range(min(int(line), len(lines)) - 1, -1, -1):
+            for r in _FUNC_DEF_RES:
+                m = re.match(r, lines[i])
+                if m:
+                    return m.group(1).split('::')[-1]
+        return None
+
+    def lookup(self, sym):
+        defs = []
+        for batch in self.api.iter_search('def', sym, limit=self.limit):
+            defs.extend((self.local_path(l), l.line_num) for l in batch.locations)
+        refs = []
+        for batch in self.api.iter_search('symbol', sym, limit=self.limit):
+            refs.extend((self.local_path(l), l.line_num) for l in batch.locations)
+
+        def_set = set((f, str(l)) for f, l in defs)
+        callers = []
+        seen = set()
+        for f, l in refs:
+            if (f, str(l)) in def_set:
+                continue
+            caller = self.enclosing(f, l) if l else None
+            # one entry per caller, but keep every unknown site
+            if caller is not None:
+                if caller in seen:
+                    continue
+                seen.add(caller)
+            callers.append((caller, f, l))
+        return defs, callers
+
+    # look up every symbol in level at once, returns the next level
+    def expand(self, level, pool):
+        todo = [s for s in level if s not in self.memo]
+        todo = todo[:max(0, self.budget - len(self.memo))]
+        futures = {pool.submit(self.lookup, s): s for s in todo}
+        for f in concurrent.futures.as_completed(futures):
+            try:
+                self.memo[futures[f]] = f.result()
+            except Exception as e:
+                self.memo[futures[f]] = ([], [])
+                self.errors[futures[f]] = str(e)
+
+        nxt = []
+        for s in todo:
+            for caller, _, _ in self.memo[s][1]:
+                if caller and caller not in self.memo and caller not in nxt:
+                    nxt.append(caller)
+        return nxt
+
+    def render(self, depth):
+        out = []
+        def walk(sym, site, indent, path):
+            label = sym if sym else '?'
+            if site:
+                label += '  {}:{}'.format(site[0], site[1])
+            elif sym in self.memo and self.memo[sym][0]:
+                label += '  {}:{}'.format(*self.memo[sym][0][0])
+            if sym in self.errors:
+                label += '  <error: {}>'.format(self.errors[sym])
+            if sym in path:
+                out.append('  ' * indent + label + '  (recursive)')
+                return
+            out.append('  ' * indent + label)
+            if sym not in self.memo or indent >= depth:
+                return
+            for caller, f, l in self.memo[sym][1]:
+                walk(caller, (f, l), indent + 1, path | {sym})
+        walk(self.root, None, 0, frozenset())
+        return out
+
+
+
 
 
+# local search (LocalSearch) leaves these alone
+_LOCAL_SKIP_DIRS = set('''
+    .git .hg .svn .bzr CVS node_modules __pycache__ .tox .venv venv
+    build out dist target .cache .idea .vscode
+'''.split())
+_LOCAL_MAX_SIZE = 16 * 1024 * 1024
+# only what's needed for a def search
+_LOCAL_DEF_RES = _FUNC_DEF_RES + [
+    r'^\s*#\s*define\s+([A-Za-z_]\w*)',
+    r'^.*?\b(?:class|struct|union|enum|interface|type)\s+([A-Za-z_]\w*)',
+]
+
+
+def _is_def(text, term, fuzzy):
+    for r in _LOCAL_DEF_RES:
+        m = re.match(r, text)
+        if m:
+            name = m.group(1).split('::')[-1]
+            if name == term or (fuzzy and term in name):
+                return True
+    return False
+
+
+# Runs in a worker process for LocalSearch. Finds `pattern` in each file,
+# one hit per line, and returns (path relative to the base, snippet, line)
+# with the snippet marked up like the server's.
+def _scan_files(paths, base_len, pattern, term, fuzzy, defs_only):
+    rx = re.compile(pattern)
+    out = []
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size == 0 or size > _LOCAL_MAX_SIZE:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    # NUL near the start, call it binary
+                    if mm.find(b'\0', 0, 8192) != -1:
+                        continue
+                    line = 1
+                    pos = 0
+                    for m in rx.finditer(mm):
+                        start = m.start()
+                        if start < pos:
+                            # already have this line
+                            continue
+                        line += mm[pos:start].count(b'\n')
+                        line_start = mm.rfind(b'\n', 0, start) + 1
+                        pos = mm.find(b'\n', start)
+                        if pos == -1:
+                            pos = len(mm)
+                        before = mm[line_start:start].decode('utf-8', 'replace')
+                        match = m.group(0).decode('utf-8', 'replace')
+                        after = mm[m.end():pos].decode('utf-8', 'replace').rstrip('\r')
+                        if defs_only and not _is_def(before + match + after, term, fuzzy):
+                            continue
+                        content = '{}<b>{}</b>{}'.format(html.escape(before, False),
+                                html.escape(match, False), html.escape(after, False))
+                        out.append((path[base_len:], content, line))
+        except (OSError, ValueError):
+            # unreadable, or went away while we were looking
+            continue
+    return out
+
+
+def _local_pool(workers):
+    # Processes, so the regex isn't held to one core by the GIL. Not fork:
+    # forking the plugin host while its own threads (event loop, log
+    # listener, annotation watcher...) hold locks can deadlock the child.
+    # forkserver and spawn workers start clean and import this file by name,
+    # which works because the plugin host put its directory on sys.path.
+    import multiprocessing
+    method = 'spawn'
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        method = 'forkserver'
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+            mp_context=multiprocessing.get_context(method))
+
+
+class LocalSearch:
+    # A stand in for OpenGrokAPI.iter_search that searches the files under the
+    # local base path, for when the server is down or hasn't indexed
+    # something yet. It can't tell a definition from a use the way the server
+    # can, so def searches only keep lines that look like definitions.
+    def __init__(self, base, workers=None, stats=None):
+        self.base = base.rstrip('/\\')
+        self.workers = workers or os.cpu_count() or 2
+        self.stats = stats if stats else LatencyStats()
+        # files per task
+        self.chunk = 64
+
+    def walk(self, root):
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames
+                    if d not in _LOCAL_SKIP_DIRS and not d.startswith('.')]
+            for f in filenames:
+                path = os.path.join(dirpath, f)
+                try:
+                    # opening a fifo or device would block the worker
+                    if not stat.S_ISREG(os.lstat(path).st_mode):
+                        continue
+                except OSError:
+                    continue
+                yield path
+
+    # same as OpenGrokAPI.iter_search. Batches hold at least page_size hits
+    # (except the last). files is files scanned, total is files found so far.
+    def iter_search(self, key, s, fuzzy=False, proj_name=None, page_size=1000, limit=None):
+        root = os.path.join(self.base, proj_name) if proj_name else self.base
+        base_len = len(self.base)
+        if key == 'path':
+            yield from self._iter_paths(root, base_len, s, fuzzy, page_size, limit)
+            return
+
+        term = re.escape(s.encode())
+        if fuzzy:
+            pattern = rb'\w*' + term + rb'\w*'
+        else:
+            pattern = rb'\b' + term + rb'\b'
+        defs_only = key == 'def'
+
+        pool = _local_pool(self.workers)
+        pending = {}
+        out = []
+        state = {'start': 0, 'scanned': 0, 'walked': 0, 'hits': 0}
+
+        def collect(futures):
+            for f in futures:
+                n = pending.pop(f)
+                state['scanned'] += n
+                for path, content, line in f.result():
+                    if limit and state['hits'] >= limit:
+                        # chunks finish out of order, keep the hits to limit
+                        break
+                    out.append(Location(path, content, line))
+                    state['hits'] += 1
+
+        def batch(done):
+            b = SearchBatch(out[:], state['start'], state['scanned'], state['walked'], done)
+            state['start'] = state['scanned']
+            del out[:]
+            return b
+
+        try:
+            scan_start = time.perf_counter()
+            chunk = []
+            for path in self.walk(root):
+                chunk.append(path)
+                if len(chunk) < self.chunk:
+                    continue
+                pending[pool.submit(_scan_files, chunk, base_len, pattern, s, fuzzy, defs_only)] = len(chunk)
+                state['walked'] += len(chunk)
+                chunk = []
+                # don't let the walk get too far ahead of the scan
+                if len(pending) >= 2 * self.workers:
+                    done, _ = concurrent.futures.wait(pending,
+                            return_when=concurrent.futures.FIRST_COMPLETED)
+                    collect(done)
+                if limit and state['hits'] >= limit:
+                    break
+                if len(out) >= page_size:
+                    yield batch(False)
+            else:
+                if chunk:
+                    pending[pool.submit(_scan_files, chunk, base_len, pattern, s, fuzzy, defs_only)] = len(chunk)
+                    state['walked'] += len(chunk)
+
+            while pending and not (limit and state['hits'] >= limit):
+                done, _ = concurrent.futures.wait(pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done)
+                if len(out) >= page_size and pending:
+                    yield batch(False)
+            self.stats.add('local.search', (time.perf_counter() - scan_start) * 1000.0,
+                    files=state['scanned'])
+            yield batch(True)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _iter_paths(self, root, base_len, s, fuzzy, page_size, limit):
+        out = []
+        walked = 0
+        start = 0
+        for path in self.walk(root):
+            walked += 1
+            rel = path[base_len:]
+            if (fuzzy and s in rel) or os.path.basename(path) == s or rel.endswith('/' + s):
+                out.append(Location(rel, '', 0))
+                if limit and len(out) + start >= limit:
+                    break
+                if len(out) >= page_size:
+                    yield SearchBatch(out, start, walked, walked, False)
+                    start += len(out)
+                    out = []
+        yield SearchBatch(out, start, walked, walked, True)
+
 
 @pynvim.plugin
 class OGrokPlugin(object):
@@ -167,12 +1140,53 @@ class OGrokPlugin(object):
         self.nvim = nvim
         self.api = None
         self.path = None
-        # map from window id to the array of Marks
+        # more (OpenGrokAPI, base path) pairs that get searched alongside
+        # self.api. See OGrokAddServer.
+        self.extra_servers = []
+        # seconds to wait for each server when searching more than one
+        self.server_timeout = 10
+        # concurrent lookups for OGrokBatch and OGrokCallTree
+        self.batch_workers = 8
+        # most symbols OGrokCallTree will look up
+        self.calltree_budget = 200
+        # map from window handle to a deque of Marks (newest on the right)
         self.marks = {}
-        self.log = None
+        # how many marks to keep per window
+        self.stack_depth = 100
+        # optional sqlite file the stacks are saved to on exit
+        self.stack_db = None
+        # see OGrokSetLogFile
+        self.log = StructuredLog()
+        # stop a search after this many hits, None for no limit
+        self.max_results = 10000
+        # timings for OGrokStats
+        self.stats = LatencyStats()
+        self.stats.log = self.log
+
+        # previous searches, see OGrokHistory
+        self.history = SearchHistory()
 
         # sqlite3 database on disk
         self.annotations_db = None
+        self.annotations_ready = False
+        # seconds to wait on another editor's lock before giving up
+        self.annotations_timeout = 10.0
+        # switch the db to WAL mode. Don't on network filesystems
+        self.annotations_wal = False
+        # seconds between checks for other editors' changes, 0 for never
+        self.annotations_poll = 2.0
+        self.annotations_watcher = None
+        # last AnnotationLog entry we've seen
+        self.annotations_seq = 0
+        # only decorate the lines on screen (plus margin lines either side),
+        # with extmarks instead of signs, see render_viewport
+        self.annotations_viewport = False
+        self.annotations_margin = 50
+        self.annotation_ns = None
+        # buffer number -> [(first, last)] lines decorated, one per window
+        self.viewport_ranges = {}
+        # mark search results that have notes
+        self.picker_notes = False
         # dict for signs that are active so we can quickly get the annotation
         # and clean up later
         #    (fname, line) -> (note, tags, id)
@@ -188,14 +1202,33 @@ class OGrokPlugin(object):
         # When the session dies, there's a noticable lag in getting the server resp
         self.keepalive_thread = None
 
-        self.tmp_saved_locations = None
-        # the buffer that the user was originally in before we made a new one
-        self.tmp_work_buffer= None
-        self.tmp_work_window = None
-        self.tmp_col = None
-        self.tmp_row = None
+        # open pickers, picker buffer handle -> PickerSession. Several can be
+        # open at once, in different windows. Dropped when the buffer is
+        # wiped (they're bufhidden=wipe), see on_buf_wipeout
+        self.pickers = {}
+        self.pickers_lock = threading.Lock()
+
+        # line start offsets of local files, for checking line numbers
+        self.line_index = LineIndex()
+        # how many lines either side of the server's line number to look
+        self.drift_radius = 2000
+
+        # only fetch a page at a time and get more as the picker is scrolled
+        self.lazy_picker = False
+        self.lazy_page_size = 100
+
+        # search the local files of the current project, see LocalSearch.
+        # 0: never, 1: when the server fails, 2: also when it finds nothing
+        self.local_fallback = 1
+        # worker processes for that, None for one per cpu
+        self.local_workers = None
 
 
+    # where a result lives on the local filesystem
+    def local_path(self, loc):
+        base = loc.base if loc.base is not None else self.path
+        return '{}{}'.format(base, loc.path)
+
     def normalize_path(self, path):
         # idk... there's a problem where the call commands :blah <path>
         # where things go bad if there are backslashes in the path.
@@ -206,17 +1239,27 @@ class OGrokPlugin(object):
             # get?
             return None
 
+    def annotations_connect(self):
+        import sqlite3
+        # other editors may be writing to the same db, wait for them instead
+        # of failing with "database is locked"
+        return sqlite3.connect(self.annotations_db, timeout=self.annotations_timeout)
+
     def setup_signs(self):
         if self.annotations_db == None:
             raise("OGrok: annotation database file must be set")
 
         conn = None
         try:
-            conn = sqlite3.connect(self.annotations_db)
+            conn = self.annotations_connect()
             cur = conn.cursor()
-            tables = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='AnnotationTable'").fetchall()
-            if len(tables) == 0:
-                cur.execute("CREATE TABLE AnnotationTable(file, line, annotation, tags)")
+            if self.annotations_wal:
+                # sticks to the file, so only needs doing once
+                cur.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                for stmt in _ANNOTATION_SCHEMA:
+                    cur.execute(stmt)
+            self.annotations_seq = cur.execute("SELECT COALESCE(MAX(seq), 0) FROM AnnotationLog").fetchone()[0]
 
         except Exception as e:
             self.nvim.err_write(f"OGrok: Failed SQL operation during setup: {e}")
@@ -242,6 +1285,7 @@ class OGrokPlugin(object):
                 self.nvim.command(def_sign)
             else:
                 raise(e)
+        self.annotation_ns = self.nvim.request('nvim_create_namespace', 'ogrok_annotations')
 
 
 
@@ -271,10 +1315,7 @@ class OGrokPlugin(object):
             # if we have a location to save
 
             # save cur location in the tag stack (for the given window)
-            if win in self.marks:
-                self.marks[win].append(Mark(curr_fpath, row, col))
-            else:
-                self.marks[win] = [Mark(curr_fpath, row, col)]
+            self.push_mark(win.handle, Mark(curr_fpath, row, col))
 
         # get next location
         new_line_num = None
@@ -327,11 +1368,10 @@ class OGrokPlugin(object):
         fname = data[0][0]
 
         # XXX duplicated a bunch of this. Make a function for it
-        self.tmp_work_buffer = self.nvim.request('nvim_get_current_buf')
-        self.tmp_work_window = self.nvim.request('nvim_get_current_win')
-        self.tmp_row, self.tmp_col = self.nvim.request('nvim_win_get_cursor', 0)
+        work_window = self.nvim.request('nvim_get_current_win')
+        row, col = self.nvim.request('nvim_win_get_cursor', 0)
 
-        line = self.tmp_row
+        line = row
 
 
         # created a buf... need to clean up on err
@@ -355,7 +1395,7 @@ class OGrokPlugin(object):
             key_map_opts = {'silent': True, 'nowait': True, 'noremap': True}
             # close this window+buffer. Go back to correct window
             close_cmd = ':close | '
-            close_cmd += 'call nvim_set_current_win({})<CR>'.format(self.tmp_work_window.handle)
+            close_cmd += 'call nvim_set_current_win({})<CR>'.format(work_window.handle)
             for key in closing_keys:
                 self.nvim.request('nvim_buf_set_keymap', new_buf,
                         'n', key, close_cmd, key_map_opts)
@@ -393,13 +1433,22 @@ class OGrokPlugin(object):
             self.nvim.out_write(f'OGrok: annotations database path must be set.\n')
             return
 
-        data = self.__OGrokTryGetNotesForFile()
-        self.__OGrokTrySetNotesForFile(data)
+        self.show_notes_for_file()
+
+    def show_notes_for_file(self):
+        if self.annotations_viewport:
+            # forget what was drawn, the buffer may have been reloaded
+            self.viewport_ranges.pop(self.nvim.current.buffer.number, None)
+            self.render_viewport()
+        else:
+            data = self.__OGrokTryGetNotesForFile()
+            self.__OGrokTrySetNotesForFile(data)
 
 
 
     # XXX so we can call it ourselves. Probabl don't need to actually do this this way
     def __OGrokTryGetNotesForFile(self):
+        self.ensure_annotations()
         # vim cares about the bufname
         bufname = self.nvim.request('nvim_buf_get_name', 0)
 
@@ -417,9 +1466,10 @@ class OGrokPlugin(object):
         conn = None
         data = []
         try:
-            conn = sqlite3.connect(self.annotations_db)
+            conn = self.annotations_connect()
             cur = conn.cursor()
-            data = cur.execute("SELECT file, line, annotation, tags from AnnotationTable WHERE file=?", (fname,)).fetchall()
+            with self.stats.timed('sql.notes'):
+                data = cur.execute("SELECT file, line, annotation, tags from AnnotationTable WHERE file=?", (fname,)).fetchall()
         except Exception as e:
             self.nvim.err_write(f"OGrok: Failed SQL operation: {e}\n")
             raise(e)
@@ -449,17 +1499,18 @@ class OGrokPlugin(object):
             #self.nvim.out_write(f'OGrok: no annotations for {fname}.\n')
             return
 
-        for f, l, note, tags in data:
-            if f != fname:
-                raise Exception(f'{f} != {fname}')
-            if (f,l) not in self.annotation_ids.keys():
-                cmd = f':sign place {self.annotation_counter} name=OGrokAnnotationSign line={l} file={bufname}'
-                self.nvim.command(cmd)
-                self.annotation_ids[(f,l)]  = (note, tags, self.annotation_counter)
-                self.annotation_counter += 1
-            else:
-                oldnote, oldtags, idd = self.annotation_ids[(f,l)]
-                self.annotation_ids[(f,l)] = (note, tags, idd)
+        with self.stats.timed('signs.place', n=len(data)):
+            for f, l, note, tags in data:
+                if f != fname:
+                    raise Exception(f'{f} != {fname}')
+                if (f,l) not in self.annotation_ids.keys():
+                    cmd = f':sign place {self.annotation_counter} name=OGrokAnnotationSign line={l} file={bufname}'
+                    self.nvim.command(cmd)
+                    self.annotation_ids[(f,l)]  = (note, tags, self.annotation_counter)
+                    self.annotation_counter += 1
+                else:
+                    oldnote, oldtags, idd = self.annotation_ids[(f,l)]
+                    self.annotation_ids[(f,l)] = (note, tags, idd)
 
 
 
@@ -485,16 +1536,14 @@ class OGrokPlugin(object):
 
         # we're going to read from our dict. need to make sure it's setup first.
         if len(self.annotation_ids) == 0:
-            data = self.__OGrokTryGetNotesForFile()
-            self.__OGrokTrySetNotesForFile(data)
+            self.show_notes_for_file()
 
 
         # XXX duplicated a bunch of this. Make a function for it
-        self.tmp_work_buffer = self.nvim.request('nvim_get_current_buf')
-        self.tmp_work_window = self.nvim.request('nvim_get_current_win')
-        self.tmp_row, self.tmp_col = self.nvim.request('nvim_win_get_cursor', 0)
+        work_window = self.nvim.request('nvim_get_current_win')
+        row, col = self.nvim.request('nvim_win_get_cursor', 0)
 
-        line = self.tmp_row
+        line = row
 
         note, sign_id = '', -1
         tags = ''
@@ -523,7 +1572,7 @@ class OGrokPlugin(object):
             key_map_opts = {'silent': True, 'nowait': True, 'noremap': True}
             # close this window+buffer. Go back to correct window
             close_cmd = ':close | '
-            close_cmd += 'call nvim_set_current_win({})<CR>'.format(self.tmp_work_window.handle)
+            close_cmd += 'call nvim_set_current_win({})<CR>'.format(work_window.handle)
             for key in closing_keys:
                 self.nvim.request('nvim_buf_set_keymap', new_buf,
                         'n', key, close_cmd, key_map_opts)
@@ -651,18 +1700,16 @@ class OGrokPlugin(object):
         note = '\n'.join(content)
         tags = ', '.join(taglist)
 
-        # default
-        signname = 'OGrokAnnotationSign' 
-        for tag in taglist:
-            if tag in self.signstyle_tag_map.keys():
-                signname = self._tagname2signname(tag)
-
-
+        self.ensure_annotations()
         conn = None
+        sql_start = time.perf_counter()
         try:
-            conn = sqlite3.connect(self.annotations_db)
+            conn = self.annotations_connect()
             cur = conn.cursor()
 
+            # take the write lock up front so another editor can't add the
+            # same note between our SELECT and INSERT
+            cur.execute('BEGIN IMMEDIATE')
             existing = cur.execute('SELECT file, line FROM AnnotationTable WHERE file=? AND line=?', (fname, lineno)).fetchall()
             if len(existing) > 1:
                 # this shouldn't happen
@@ -674,7 +1721,7 @@ class OGrokPlugin(object):
                     conn.commit()
                 else:
                     # nothing in db and our annotation is empty. Nothing to do
-                    pass
+                    conn.rollback()
             else:
                 if len(note) > 0 or len(tags) > 0:
                     # something already there and we have a note. Update existing
@@ -688,33 +1735,192 @@ class OGrokPlugin(object):
 
         except Exception as e:
             self.nvim.err_write(f"OGrok: Failed SQL operation: {e}\n")
+            self.log.error('add_note_failed', file=fname, line=lineno, error=str(e))
             raise(e)
         finally:
             if conn:
                 conn.close()
+            self.stats.add('sql.add_note', (time.perf_counter() - sql_start) * 1000.0)
+
+        self.update_sign(fname, bufname, lineno, note, tags)
+
+    def tags2signname(self, tags):
+        # default
+        signname = 'OGrokAnnotationSign'
+        for tag in (tags or '').split(','):
+            tag = tag.strip()
+            if tag in self.signstyle_tag_map.keys():
+                signname = self._tagname2signname(tag)
+        return signname
+
+    # (chars, highlight) of the sign for these tags
+    def tags2style(self, tags):
+        # default, see setup_signs
+        style = ('>>', 'Error')
+        for tag in (tags or '').split(','):
+            tag = tag.strip()
+            if tag in self.signstyle_tag_map.keys():
+                style = self.signstyle_tag_map[tag]
+        return style
 
+    # add, move or remove the sign for one note. An empty note with no tags
+    # (or None, when it was deleted) removes it.
+    def update_sign(self, fname, bufname, lineno, note, tags, bufnr=None):
         already = (fname, lineno) in self.annotation_ids.keys()
-        if (len(note) > 0 or len(tags) > 0):
+        if self.annotations_viewport:
+            if bufnr is None:
+                bufnr = self.nvim.call('bufnr', bufname)
+            ranges = self.viewport_ranges.get(bufnr, [])
+            if not any(lo <= lineno <= hi for lo, hi in ranges):
+                # off screen, it's drawn when it's scrolled to
+                note, tags = None, None
+        if note or tags:
+            if already:
+                oldnote, oldtags, idd = self.annotation_ids[(fname, lineno)]
+                if (oldnote, oldtags) == (note, tags):
+                    # e.g. our own change coming back from the watcher
+                    return
+            if self.annotations_viewport:
+                if not already:
+                    idd = self.annotation_counter
+                    self.annotation_counter += 1
+                # same id replaces it
+                self.set_note_mark(bufnr, idd, lineno, note, tags)
+                self.annotation_ids[(fname,lineno)] = (note, tags, idd)
+                return
             # add mark, remove old one if necessary
+            signname = self.tags2signname(tags)
             cmd = f':sign place {self.annotation_counter} name={signname} line={lineno} file={bufname}'
             self.nvim.command(cmd)
             if already:
-                _, _, idd = self.annotation_ids[(fname, lineno)]
                 cmd = f':sign unplace {idd} file={bufname}'
                 self.nvim.command(cmd)
-                self.annotation_ids.pop((fname,lineno))
             self.annotation_ids[(fname,lineno)] = (note, tags, self.annotation_counter)
             self.annotation_counter += 1
-        else:
-            _, _, idd = self.annotation_ids[(fname, lineno)]
+        elif already:
+            _, _, idd = self.annotation_ids.pop((fname, lineno))
+            if self.annotations_viewport:
+                self.nvim.request('nvim_buf_del_extmark', bufnr, self.annotation_ns, idd)
+                return
             cmd = f':sign unplace {idd} file={bufname}'
             self.nvim.command(cmd)
-            self.annotation_ids.pop((fname,lineno))
-        #elif len(note) == 0  and len(tags) == 0 and already:
-            #_, _, idd = self.annotation_ids[(fname, lineno)]
-            #cmd = f':sign unplace {idd} file={bufname}'
-            #self.nvim.command(cmd)
-            #self.annotation_ids.pop((fname,lineno))
+
+    # sign plus the first line of the note at the end of the line
+    def set_note_mark(self, bufnr, idd, lineno, note, tags):
+        chars, hl = self.tags2style(tags)
+        text = (note or '').split('\n', 1)[0].strip()
+        if len(text) == 0:
+            text = tags
+        opts = {
+            'id'            : idd,
+            'sign_text'     : chars,
+            'sign_hl_group' : hl,
+            'virt_text'     : [['  ' + text, 'Comment']],
+            'virt_text_pos' : 'eol',
+        }
+        self.nvim.request('nvim_buf_set_extmark', bufnr, self.annotation_ns, lineno - 1, 0, opts)
+
+    # Viewport mode: decorate the lines the current buffer's windows show,
+    # plus a margin, and drop what scrolled out of that. Costs about a
+    # screenful of notes no matter how many the file has.
+    # win is the window that moved (0 for the current one), its buffer is
+    # the one we decorate
+    def render_viewport(self, win=0):
+        buf = self.nvim.request('nvim_win_get_buf', win)
+        bufname = self.nvim.request('nvim_buf_get_name', buf)
+        if len(bufname) == 0:
+            return
+        fname = self.normalize_path(bufname)
+        if None == fname:
+            return
+        self.ensure_annotations()
+        bufnr = buf.number
+        visible = [(w['topline'], w['botline'])
+                for w in self.nvim.call('getwininfo') if w['bufnr'] == bufnr]
+        drawn = self.viewport_ranges.get(bufnr, [])
+        if all(any(lo <= top and bot <= hi for lo, hi in drawn) for top, bot in visible):
+            # still inside the margin
+            return
+        last = self.nvim.request('nvim_buf_line_count', bufnr)
+        m = self.annotations_margin
+        ranges = sorted((max(1, top - m), min(last, bot + m)) for top, bot in visible)
+
+        conn = None
+        try:
+            conn = self.annotations_connect()
+            where = ' OR '.join(['line BETWEEN ? AND ?'] * len(ranges))
+            params = [fname] + [n for r in ranges for n in r]
+            with self.stats.timed('sql.viewport'):
+                rows = conn.execute(f"SELECT line, annotation, tags FROM AnnotationTable WHERE file=? AND ({where})", params).fetchall()
+        except Exception as e:
+            self.nvim.err_write(f"OGrok: Failed SQL operation: {e}\n")
+            raise(e)
+        finally:
+            if conn:
+                conn.close()
+
+        self.viewport_ranges[bufnr] = ranges
+        want = {l: (note, tags) for l, note, tags in rows}
+        gone = [l for f, l in self.annotation_ids.keys() if f == fname and l not in want]
+        with self.stats.timed('signs.viewport', n=len(want) + len(gone)):
+            for l in gone:
+                self.update_sign(fname, bufname, l, None, None, bufnr)
+            for l, (note, tags) in want.items():
+                self.update_sign(fname, bufname, l, note, tags, bufnr)
+
+    @pynvim.autocmd('WinScrolled', pattern='*', eval='expand("<amatch>")')
+    def on_win_scrolled(self, win_id):
+        # <amatch> is the handle of the window that scrolled, which isn't
+        # always the current one (e.g. scrollbind, mouse wheel)
+        if not (self.annotations_viewport and self.annotations_db):
+            return
+        try:
+            win = int(win_id)
+        except ValueError:
+            return
+        if self.nvim.request('nvim_win_is_valid', win):
+            self.render_viewport(win)
+
+    # runs on the main thread, with what AnnotationWatcher found
+    def apply_annotation_changes(self, changes):
+        if not self.annotations_ready:
+            # db was changed or closed in the meantime
+            return
+        # only loaded buffers have signs, the rest get theirs on BufEnter
+        open_files = {}
+        for info in self.nvim.call('getbufinfo', {'bufloaded': 1}):
+            if len(info['name']) > 0:
+                fname = self.normalize_path(info['name'])
+                if fname:
+                    open_files[fname] = (info['name'], info['bufnr'])
+
+        if changes is None:
+            # too much changed, reload the notes for the open files
+            self.log.info('annotations_reload', files=len(open_files))
+            changes = [(f, l, None, None) for f, l in self.annotation_ids.keys()
+                    if f in open_files]
+            conn = None
+            try:
+                conn = self.annotations_connect()
+                for fname in open_files.keys():
+                    changes.extend(conn.execute("SELECT file, line, annotation, tags from AnnotationTable WHERE file=?", (fname,)).fetchall())
+            finally:
+                if conn:
+                    conn.close()
+
+        with self.stats.timed('signs.update', n=len(changes)):
+            for f, l, note, tags in changes:
+                if f in open_files:
+                    bufname, bufnr = open_files[f]
+                    self.update_sign(f, bufname, l, note, tags, bufnr)
+                elif (f, l) in self.annotation_ids.keys():
+                    # no sign to move, but keep what OGrokDoAnnotation shows
+                    # up to date
+                    if note or tags:
+                        _, _, idd = self.annotation_ids[(f, l)]
+                        self.annotation_ids[(f, l)] = (note, tags, idd)
+                    else:
+                        self.annotation_ids.pop((f, l))
 
 
     @pynvim.command('OGrokDumpAnnotationShadow', nargs='0', range='')
@@ -729,7 +1935,110 @@ class OGrokPlugin(object):
         if len(args) < 1:
             raise Exception("Path argument required.")
         self.annotations_db = args[0]
-        self.setup_signs()
+        # the table and signs get set up on first use, see ensure_annotations
+        self.annotations_ready = False
+        self.stop_annotation_watcher()
+
+    def ensure_annotations(self):
+        if not self.annotations_ready:
+            self.setup_signs()
+            self.annotations_ready = True
+            self.start_annotation_watcher()
+
+    def start_annotation_watcher(self):
+        if self.annotations_poll <= 0 or self.annotations_watcher:
+            return
+        def callback(changes):
+            self.nvim.async_call(self.apply_annotation_changes, changes)
+        self.annotations_watcher = AnnotationWatcher(self.annotations_db,
+                self.annotations_seq, self.annotations_poll,
+                self.annotations_timeout, callback)
+        self.annotations_watcher.start()
+
+    def stop_annotation_watcher(self):
+        if self.annotations_watcher:
+            self.annotations_watcher.stop()
+            # pick up from here if it's restarted
+            self.annotations_seq = self.annotations_watcher.seq
+            self.annotations_watcher = None
+
+    # args: seconds, 0 to stop checking for other editors' notes
+    @pynvim.command('OGrokSetAnnotationPoll', nargs='*', range='', sync=True)
+    def OGrokSetAnnotationPoll(self, args, range):
+        # autocmd VimEnter * OGrokSetAnnotationPoll 5
+        if len(args) < 1:
+            raise Exception("Seconds required.")
+        try:
+            self.annotations_poll = float(args[0])
+        except Exception as e:
+            raise Exception('OGrok: Failed to set annotation poll: {}'.format(e))
+        self.stop_annotation_watcher()
+        if self.annotations_ready:
+            self.start_annotation_watcher()
+
+    # args: seconds to wait for another editor's write lock
+    @pynvim.command('OGrokSetAnnotationTimeout', nargs='*', range='', sync=True)
+    def OGrokSetAnnotationTimeout(self, args, range):
+        # autocmd VimEnter * OGrokSetAnnotationTimeout 30
+        if len(args) < 1:
+            raise Exception("Seconds required.")
+        try:
+            self.annotations_timeout = max(0.0, float(args[0]))
+        except Exception as e:
+            raise Exception('OGrok: Failed to set annotation timeout: {}'.format(e))
+
+    # args: 0|1 [margin lines]
+    @pynvim.command('OGrokSetAnnotationViewport', nargs='*', range='', sync=True)
+    def OGrokSetAnnotationViewport(self, args, range):
+        # autocmd VimEnter * OGrokSetAnnotationViewport 1 100
+        if len(args) < 1:
+            raise Exception("0 or 1 required.")
+        viewport = "0" != args[0]
+        if len(args) > 1:
+            try:
+                self.annotations_margin = max(0, int(args[1]))
+            except Exception as e:
+                raise Exception('OGrok: Failed to set margin: {}'.format(e))
+        if viewport != self.annotations_viewport:
+            # signs and extmarks don't mix, take down what's there
+            self.clear_annotation_marks()
+            self.annotations_viewport = viewport
+            if self.annotations_db:
+                self.show_notes_for_file()
+
+    def clear_annotation_marks(self):
+        for (f, l), (_, _, idd) in self.annotation_ids.items():
+            try:
+                if self.annotations_viewport:
+                    bufnr = self.nvim.call('bufnr', f)
+                    if bufnr > 0:
+                        self.nvim.request('nvim_buf_del_extmark', bufnr, self.annotation_ns, idd)
+                else:
+                    self.nvim.command(f':sign unplace {idd} file={f}')
+            except pynvim.api.common.NvimError:
+                # buffer is gone, and its marks with it
+                pass
+        self.annotation_ids.clear()
+        self.viewport_ranges.clear()
+
+    # args: 0|1
+    @pynvim.command('OGrokSetPickerNotes', nargs='*', range='', sync=True)
+    def OGrokSetPickerNotes(self, args, range):
+        # autocmd VimEnter * OGrokSetPickerNotes 1
+        if len(args) < 1:
+            raise Exception("0 or 1 required.")
+        self.picker_notes = "0" != args[0]
+
+    # args: 0|1
+    @pynvim.command('OGrokSetAnnotationWAL', nargs='*', range='', sync=True)
+    def OGrokSetAnnotationWAL(self, args, range):
+        # autocmd VimEnter * OGrokSetAnnotationWAL 1
+        if len(args) < 1:
+            raise Exception("0 or 1 required.")
+        self.annotations_wal = "0" != args[0]
+        # applied when the db is opened
+        self.annotations_ready = False
+        self.stop_annotation_watcher()
 
 
 
@@ -741,6 +2050,115 @@ class OGrokPlugin(object):
             self.nvim.out_write('OGrok: No annotation database.\n')
 
 
+    # args: file [old_prefix new_prefix]
+    # One json object per line, {"file", "line", "annotation", "tags"}. File
+    # names starting with old_prefix get new_prefix instead.
+    @pynvim.command('OGrokExportAnnotations', nargs='*', range='', sync=True)
+    def OGrokExportAnnotations(self, args, range):
+        if len(args) not in (1, 3):
+            raise Exception("Provide a file, and optionally old and new path prefixes.")
+        if None == self.annotations_db:
+            self.nvim.out_write(f'OGrok: annotations database path must be set.\n')
+            return
+        self.ensure_annotations()
+        out = os.path.expanduser(args[0])
+        rewrite = args[1:]
+
+        count = 0
+        conn = None
+        start = time.perf_counter()
+        try:
+            conn = self.annotations_connect()
+            # a page of rows at a time, never the whole table
+            cur = conn.execute("SELECT file, line, annotation, tags FROM AnnotationTable ORDER BY file, line")
+            # written next to the target and moved over it at the end
+            with open(out + '.tmp', 'w') as f:
+                while True:
+                    rows = cur.fetchmany(1000)
+                    if len(rows) == 0:
+                        break
+                    for fname, line, note, tags in rows:
+                        if rewrite:
+                            fname = _rewrite_prefix(fname, *rewrite)
+                        f.write(json.dumps({'file': fname, 'line': line,
+                            'annotation': note, 'tags': tags}) + '\n')
+                    count += len(rows)
+            os.replace(out + '.tmp', out)
+        except Exception as e:
+            self.nvim.err_write(f"OGrok: Failed to export annotations: {e}\n")
+            self.log.error('export_annotations_failed', path=out, error=str(e))
+            return
+        finally:
+            if conn:
+                conn.close()
+        ms = (time.perf_counter() - start) * 1000.0
+        self.log.info('export_annotations', path=out, notes=count, ms=round(ms, 3))
+        self.nvim.out_write(f'OGrok: exported {count} annotations to {out}.\n')
+
+    # args: file [old_prefix new_prefix]
+    # Reads what OGrokExportAnnotations writes. A note for a file and line that
+    # already has one replaces it. All or nothing.
+    @pynvim.command('OGrokImportAnnotations', nargs='*', range='', sync=True)
+    def OGrokImportAnnotations(self, args, range):
+        if len(args) not in (1, 3):
+            raise Exception("Provide a file, and optionally old and new path prefixes.")
+        if None == self.annotations_db:
+            self.nvim.out_write(f'OGrok: annotations database path must be set.\n')
+            return
+        self.ensure_annotations()
+        src = os.path.expanduser(args[0])
+        rewrite = args[1:]
+
+        # streamed straight from the file into executemany
+        def rows(f):
+            for n, line in enumerate(f, 1):
+                if len(line.strip()) == 0:
+                    continue
+                try:
+                    d = json.loads(line)
+                    fname = d['file']
+                    if rewrite:
+                        fname = _rewrite_prefix(fname, *rewrite)
+                    yield (fname, int(d['line']), d.get('annotation') or '', d.get('tags') or '')
+                except Exception as e:
+                    raise Exception(f'{src}:{n}: {e}')
+
+        count = 0
+        conn = None
+        start = time.perf_counter()
+        try:
+            conn = self.annotations_connect()
+            cur = conn.cursor()
+            # one transaction for the lot, committing per row is what makes
+            # this slow
+            cur.execute('BEGIN IMMEDIATE')
+            cur.execute("CREATE TEMP TABLE OGrokImport(file, line, annotation, tags)")
+            with open(src) as f:
+                cur.executemany("INSERT INTO OGrokImport VALUES (?, ?, ?, ?)", rows(f))
+            count = cur.execute("SELECT COUNT(*) FROM OGrokImport").fetchone()[0]
+            cur.execute("CREATE INDEX temp.OGrokImportFileLine ON OGrokImport(file, line)")
+            cur.execute('''DELETE FROM AnnotationTable WHERE EXISTS (SELECT 1 FROM OGrokImport i
+                WHERE i.file = AnnotationTable.file AND i.line = AnnotationTable.line)''')
+            # the last one wins if the file has the same line twice
+            cur.execute('''INSERT INTO AnnotationTable (file, line, annotation, tags)
+                SELECT file, line, annotation, tags FROM OGrokImport
+                WHERE rowid IN (SELECT MAX(rowid) FROM OGrokImport GROUP BY file, line)''')
+            cur.execute("DROP TABLE OGrokImport")
+            conn.commit()
+        except Exception as e:
+            self.nvim.err_write(f"OGrok: Failed to import annotations: {e}\n")
+            self.log.error('import_annotations_failed', path=src, error=str(e))
+            return
+        finally:
+            if conn:
+                conn.close()
+        ms = (time.perf_counter() - start) * 1000.0
+        self.log.info('import_annotations', path=src, notes=count, ms=round(ms, 3))
+        self.nvim.out_write(f'OGrok: imported {count} annotations from {src}.\n')
+        # signs for whatever is open
+        self.apply_annotation_changes(None)
+
+
     @pynvim.command('OGrokSetBasePath', nargs='*', range='', sync=True)
     def OGrokSetBasePath(self, args, range):
         # autocmd VimEnter * OGrokSetBasePath /home/user/src
@@ -804,42 +2222,143 @@ class OGrokPlugin(object):
 
 
 
+    # args: path [max size in MB] [number of old files to keep]
     @pynvim.command('OGrokSetLogFile', nargs='*', range='', sync=True)
     def OGrokSetLogFile(self, args, range):
-        # autocmd VimEnter * OGrokSetBasePath /home/user/src
+        # autocmd VimEnter * OGrokSetLogFile /tmp/ogrok.jsonl 10 3
         if len(args) < 1:
             raise Exception("Path argument required.")
-        self.log = args[0]
+        max_mb, backups = 10, 3
+        try:
+            if len(args) > 1:
+                max_mb = float(args[1])
+            if len(args) > 2:
+                backups = int(args[2])
+        except Exception as e:
+            raise Exception('OGrok: Failed to set log file: {}'.format(e))
+        self.log.open(os.path.expanduser(args[0]), int(max_mb*1024*1024), backups)
+
+    @pynvim.command('OGrokSetLogLevel', nargs='*', range='', sync=True)
+    def OGrokSetLogLevel(self, args, range):
+        # autocmd VimEnter * OGrokSetLogLevel debug
+        if len(args) < 1:
+            raise Exception("Level argument required.")
+        self.log.set_level(args[0].lower())
+
+    # args: [reset]
+    @pynvim.command('OGrokSetMaxResults', nargs='*', range='', sync=True)
+    def OGrokSetMaxResults(self, args, range):
+        # autocmd VimEnter * OGrokSetMaxResults 50000
+        # 0 means no limit
+        if len(args) < 1:
+            raise Exception("Number of results required, 0 for no limit.")
+        try:
+            n = int(args[0])
+        except Exception as e:
+            raise Exception('OGrok: Failed to set max results: {}'.format(e))
+        self.max_results = n if n > 0 else None
+
+    # args: 0|1 [page size]
+    @pynvim.command('OGrokSetLazyPicker', nargs='*', range='', sync=True)
+    def OGrokSetLazyPicker(self, args, range):
+        # autocmd VimEnter * OGrokSetLazyPicker 1 100
+        if len(args) < 1:
+            raise Exception("0 or 1 required.")
+        self.lazy_picker = "0" != args[0]
+        if len(args) > 1:
+            try:
+                self.lazy_page_size = max(1, int(args[1]))
+            except Exception as e:
+                raise Exception('OGrok: Failed to set page size: {}'.format(e))
+
+    # args: 0|1|2 [worker processes]
+    @pynvim.command('OGrokSetLocalFallback', nargs='*', range='', sync=True)
+    def OGrokSetLocalFallback(self, args, range):
+        # autocmd VimEnter * OGrokSetLocalFallback 2 4
+        if len(args) < 1:
+            raise Exception("0, 1 or 2 required.")
+        try:
+            self.local_fallback = int(args[0])
+        except Exception as e:
+            raise Exception('OGrok: Failed to set local fallback: {}'.format(e))
+        if len(args) > 1:
+            try:
+                self.local_workers = max(1, int(args[1]))
+            except Exception as e:
+                raise Exception('OGrok: Failed to set local workers: {}'.format(e))
+
+    @pynvim.command('OGrokStats', nargs='*', range='', sync=True)
+    def OGrokStats(self, args, range):
+        if len(args) > 0 and args[0] == 'reset':
+            self.stats.reset()
+            self.nvim.out_write('OGrok: stats reset.\n')
+            return
+        if len(self.stats.samples) == 0:
+            self.nvim.out_write('OGrok: no timings yet.\n')
+            return
+        self.nvim.out_write('\n'.join(self.stats.report()) + '\n')
 
     @pynvim.command('OGrokSetServer', nargs='*', range='', sync=True)
     def OGrokSetServer(self, args, range):
         # a command for the vimrc that will set this
         # autocmd VimEnter * OGrokSetServer http://example.com:8080/source 0
         host = args[0]
-        test = False
-        if len(args) > 1:
-            test = args[1]
-            if test == "1":
-                test = True
+        test = len(args) > 1 and args[1] == "1"
+
+        # nothing here touches the network, so it's cheap to run on VimEnter
+        self.api = OpenGrokAPI(host, False, self.stats)
+        if test:
+            self.probe_in_background(self.api)
 
-        # we don't want them to give an entire backtrace if there's an exception
-        raise_flag = False
-        raise_val = None
+    # the test=1 connection check, without holding up startup. Complains if
+    # the server isn't there.
+    def probe_in_background(self, api):
+        def probe():
+            try:
+                api.probe()
+            except Exception as e:
+                self.log.error('probe_failed', server=api.addr, error=str(e))
+                self.nvim.async_call(self.nvim.err_write, '{}\n'.format(e))
+        threading.Thread(target=probe, daemon=True).start()
+
+    # args: url base_path [test]
+    @pynvim.command('OGrokAddServer', nargs='*', range='', sync=True)
+    def OGrokAddServer(self, args, range):
+        # autocmd VimEnter * OGrokAddServer http://other:8080/source /home/user/othersrc
+        if len(args) < 2:
+            raise Exception("Server url and base path required.")
+        test = len(args) > 2 and args[2] == "1"
+
+        api = OpenGrokAPI(args[0], False, self.stats)
+        if test:
+            self.probe_in_background(api)
+        self.extra_servers.append((api, args[1]))
+
+    @pynvim.command('OGrokClearServers', nargs='0', range='', sync=True)
+    def OGrokClearServers(self, args, range):
+        # only the extra ones, OGrokSetServer's stays
+        self.extra_servers = []
+
+    @pynvim.command('OGrokSetServerTimeout', nargs='*', range='', sync=True)
+    def OGrokSetServerTimeout(self, args, range):
+        # autocmd VimEnter * OGrokSetServerTimeout 5
+        if len(args) < 1:
+            raise Exception("Time in seconds required.")
         try:
-            self.api = OpenGrokAPI(host, test)
+            self.server_timeout = float(args[0])
         except Exception as e:
-            raise_flag = True
-            raise_val = 'OGrok: Failed to init: {}'.format(e)
-
-        if raise_flag:
-            raise Exception(raise_val)
+            raise Exception('OGrok: Failed to set server timeout: {}'.format(e))
 
     @pynvim.command('OGrokIsServerSet', nargs='0', range='', sync=True)
     def OGrokIsServerSet(self, args, range):
         if self.api:
-            self.nvim.out_write('OpenGrok server is {}\n'.format(self.api.addr))
+            self.nvim.out_write('OpenGrok server is {} (breaker {})\n'.format(
+                self.api.addr, self.api.breaker.describe()))
         else:
             self.nvim.out_write('OpenGrok server is not set.\n')
+        for api, base in self.extra_servers:
+            self.nvim.out_write('OpenGrok server {} (base path {}, breaker {})\n'.format(
+                api.addr, base, api.breaker.describe()))
 
     @pynvim.command('OGrokGetCurrentProj', nargs='0', range='', sync=True)
     def OGrokGetCurrentProj(self, args, range):
@@ -850,27 +2369,97 @@ class OGrokPlugin(object):
             self.nvim.out_write('OGrok: no current project.\n')
 
 
-    def get_current_project(self):
-        cwd = self.nvim.command_output("echo getcwd()")
+    # base defaults to OGrokSetBasePath's
+    def get_current_project(self, base=None, cwd=None):
+        if base is None:
+            base = self.path
+        if cwd is None:
+            cwd = self.nvim.command_output("echo getcwd()")
         cwd  = os.path.realpath(cwd)
+        base = os.path.realpath(base)
 
-        for proj in os.listdir(self.path):
-            projpath = os.path.realpath(self.path)
-            projpath = os.path.join(projpath, proj)
+        for proj in os.listdir(base):
+            projpath = os.path.join(base, proj)
 
             common = os.path.commonpath([projpath, cwd])
             head, tail = os.path.split(common)
-            if tail == proj and head == os.path.realpath(self.path):
+            if tail == proj and head == base:
                 return proj
 
         return None
 
+    # Search self.api and every extra server at once. Servers that fail or
+    # don't answer within self.server_timeout are left out, the rest are
+    # merged with duplicates (same local file and line) removed.
+    # Returns (locations, summary SearchBatch, list of error strings)
+    def federated_search(self, key, s, fuzzy, filter_proj):
+        servers = [(self.api, self.path)] + self.extra_servers
+        cwd = self.nvim.command_output("echo getcwd()")
+
+        # set once we've stopped waiting, so the slow servers stop paging
+        stop = threading.Event()
+
+        def collect(api, base, proj_name):
+            locations = []
+            batch = None
+            for batch in api.iter_search(key, s, fuzzy, proj_name, limit=self.max_results):
+                for l in batch.locations:
+                    l.base = base
+                locations.extend(batch.locations)
+                if stop.is_set():
+                    break
+            return locations, batch
+
+        projs = [None] * len(servers)
+        if filter_proj:
+            projs = [self.get_current_project(base, cwd) for _, base in servers]
+        # only the servers that have the current project. If none of them do
+        # search everything, same as with a single server.
+        only_proj = any(projs)
+
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(servers))
+        futures = []
+        for (api, base), proj_name in zip(servers, projs):
+            if only_proj and proj_name is None:
+                continue
+            futures.append((api, pool.submit(collect, api, base, proj_name)))
+        done, _ = concurrent.futures.wait([f for _, f in futures], timeout=self.server_timeout)
+        # don't hang around for the slow ones. The running ones give up after
+        # their current page, and anything that finishes from here on is
+        # partial, so only what's in done counts.
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+        locations = []
+        seen = set()
+        files, total = 0, 0
+        errors = []
+        for api, f in futures:
+            if f not in done:
+                errors.append('{} timed out'.format(api.addr))
+                continue
+            try:
+                locs, batch = f.result()
+            except Exception as e:
+                errors.append('{}: {}'.format(api.addr, e))
+                continue
+            files += batch.files
+            total += batch.total
+            for l in locs:
+                k = (self.local_path(l), l.line_num)
+                if k in seen:
+                    continue
+                seen.add(k)
+                locations.append(l)
+
+        if len(errors) == len(futures) and len(futures) > 0:
+            raise Exception('; '.join(errors))
+        return locations, SearchBatch(locations, 0, files, total, True), errors
+
     # TODO document the API here....
     @pynvim.command('OGrok', nargs='*', range='', sync=True)
     def OGrok(self, args, range):
 
-        self.tmp_saved_locations = None
-
         if self.api == None:
             self.nvim.err_write('OGrok: Cannot query without a server. See OGrokSetServer.\n')
             return
@@ -891,78 +2480,100 @@ class OGrokPlugin(object):
             fuzzy = "0" != args[2]
 
         proj_name = None
-        if len(args) == 4:
-            if "0" != args[3]:
-                proj_name = self.get_current_project()
+        filter_proj = len(args) == 4 and "0" != args[3]
+        if filter_proj:
+            proj_name = self.get_current_project()
 
 
 
-        if query_type in ['g', 'd', 'def',]:
-            query_type = 0
-        elif query_type in ['f', 'file', 'path']:
-            query_type = 1
-        elif query_type in ['s', 'sym']:
-            query_type = 2
-        else:
+        if query_type not in _QUERY_TYPES:
             raise Exception("Invalid query type. Options are def|file|sym")
+        query_type = _QUERY_TYPES[query_type]
 
-        fns = [self.api.search_def, self.api.search_path, self.api.search_symbol]
-        fn = fns[query_type]
+        key = _QUERY_KEYS[query_type]
+        kind = ['def', 'file', 'sym'][query_type]
 
+        query_start = time.perf_counter()
+        local = False
         try:
-            data = fn(query_value, -1, fuzzy, proj_name)
+            locations, batch, feed = self.fetch_results(key, query_value,
+                    fuzzy, proj_name, filter_proj)
+            if len(locations) == 0 and self.local_fallback > 1:
+                # maybe the server hasn't indexed this project yet
+                local = True
         except Exception as e:
+            self.log.error('query_failed', kind=kind, query=query_value,
+                    fuzzy=fuzzy, proj=proj_name, error=str(e))
             self.nvim.err_write('OGrok: {}.\n'.format(e))
-            return
-        locations = Location.from_ogrok_dict(data)
-        self.tmp_saved_locations = locations
-        if len(locations) == 0:
+            if not self.local_fallback:
+                return
+            local = True
+
+        if local:
+            # only ever the current project, the whole base path can be a
+            # lot to scan
+            local_proj = proj_name or self.get_current_project()
+            if None == local_proj:
+                self.nvim.out_write('OGrok: not in a project, not searching locally.\n')
+                return
+            self.nvim.out_write('OGrok: searching {} locally.\n'.format(local_proj))
+            searcher = LocalSearch(self.path, self.local_workers, self.stats)
+            # even the first page can take a while, so the picker opens empty
+            # and every page is fetched in the background, see load_more
+            feed = searcher.iter_search(key, query_value, fuzzy, local_proj,
+                    page_size=self.lazy_page_size, limit=self.max_results)
+            locations = []
+            batch = SearchBatch(locations, 0, 0, 0, False)
+
+        self.log.info('query', kind=kind, query=query_value, fuzzy=fuzzy,
+                proj=proj_name, files=batch.files, total=batch.total,
+                hits=len(locations), partial=batch.partial, local=local,
+                ms=round((time.perf_counter() - query_start) * 1000.0, 3))
+        if len(locations) == 0 and not local:
             # TODO hitting this makes you go back to the beginning of the line
             # you're on??
             self.nvim.out_write('OGrok: No results.\n')
             return
 
-        if self.log:
-            with open(self.log, 'a+') as f:
-                f.write("Data: {}".format(data))
+        with self.stats.timed('snippets', n=len(locations)):
+            contents = [l.clean_content() for l in locations]
+
+        items = [(self.local_path(l), l.line_num, c) for l, c in zip(locations, contents)]
+        history_entry = self.history.add(kind, query_value, fuzzy, proj_name, items)
+        more = feed is not None and not batch.done
 
         # XXX make a function that does this stuff...
         # save stuff off
-        self.tmp_work_buffer = self.nvim.request('nvim_get_current_buf')
-        self.tmp_work_window = self.nvim.request('nvim_get_current_win')
-        self.tmp_row, self.tmp_col = self.nvim.request('nvim_win_get_cursor', 0)
+        work_buffer = self.nvim.request('nvim_get_current_buf')
+        work_window = self.nvim.request('nvim_get_current_win')
+        row, col = self.nvim.request('nvim_win_get_cursor', 0)
+        session = PickerSession(locations, work_buffer, work_window, row, col,
+                query_type, history_entry, feed if more else None)
 
         # TODO if there's only one result, go there
 
         # created a buf... need to clean up on err
         new_buf = self.nvim.request('nvim_create_buf', False, True)
+        # so closing the picker gets rid of it, and its session
+        self.nvim.request('nvim_buf_set_option', new_buf, 'bufhidden', 'wipe')
+        with self.pickers_lock:
+            self.pickers[new_buf.handle] = session
         try:
 
-            status = '~~ {} matches. ~~ [q to quit] ~~ [<return> to select] ~~'.format(len(locations))
-            self.nvim.request('nvim_buf_set_lines', new_buf, 0, 1, True, [status])
-
-            for i,l in enumerate(locations):
-                if query_type != 1:
-                    new_buf.append('{idx} {path}:{line_num}'.format(idx=i,
-                        path=l.path, line_num=l.line_num))
-                    # XXX do this properly
-                    content = l.content.strip().replace('<b>', "")\
-                            .replace('</b>', "")\
-                            .replace('\n', 'XXXX')\
-                            .replace('\r', 'YYYY')\
-                            .replace("&gt;", ">")\
-                            .replace("&lt;", "<")\
-                            .replace("&amp;", "&")
-                    new_buf.append('        {content}'.format(content=content))
-                    new_buf.append('')
-                else:
-                    new_buf.append('{idx} {path}'.format(idx=i, path=l.path))
+            status = self.picker_status(len(locations), batch, more)
+            lines = [status] + self.format_results(locations, contents, query_type)
+            if more:
+                lines.append(_LAZY_TAIL)
+            # one request for the whole thing rather than one per line
+            with self.stats.timed('render', n=len(lines)):
+                self.nvim.request('nvim_buf_set_lines', new_buf, 0, -1, True, lines)
+            self.decorate_results(new_buf, locations, query_type)
 
             closing_keys= ['<Esc>', '<Leader>', 'q', '<BS>']
             key_map_opts = {'silent': True, 'nowait': True, 'noremap': True}
             # close this window+buffer. Go back to correct window
             close_cmd = ':close | '
-            close_cmd += 'call nvim_set_current_win({})<CR>'.format(self.tmp_work_window.handle)
+            close_cmd += 'call nvim_set_current_win({})<CR>'.format(work_window.handle)
             for key in closing_keys:
                 self.nvim.request('nvim_buf_set_keymap', new_buf,
                         'n', key, close_cmd, key_map_opts)
@@ -1000,17 +2611,223 @@ class OGrokPlugin(object):
             # idk, + and \+ don't seem to work in this regex...
             self.nvim.command(':call matchadd("LineNr", "^[0-9][0-9]*")')
             #self.nvim.command(':call matchadd("LineNr", "^~.*$")')
+
+            if more:
+                # ask for the next page once the cursor is within a screenful
+                # of the end
+                cmd = "autocmd CursorMoved <buffer={buf}> if line('.') + {margin} >= line('$') | OGrokLoadMore {buf} | endif"
+                self.nvim.command(cmd.format(buf=new_buf.number, margin=ht))
+            if local:
+                self.load_more(new_buf.handle)
         except Exception as e:
+            with self.pickers_lock:
+                self.pickers.pop(new_buf.handle, None)
             self.nvim.command(":close")
             raise e
 
+    # Returns (locations, last SearchBatch, generator for the rest of the
+    # pages or None)
+    def fetch_results(self, key, query_value, fuzzy, proj_name, filter_proj):
+        locations = []
+        batch = None
+        feed = None
+        if len(self.extra_servers) > 0:
+            locations, batch, errors = self.federated_search(key,
+                    query_value, fuzzy, filter_proj)
+            for e in errors:
+                self.log.error('server_failed', query=query_value, error=e)
+                self.nvim.err_write('OGrok: {}.\n'.format(e))
+        elif self.lazy_picker:
+            # first page now, the rest as the user scrolls
+            feed = self.api.iter_search(key, query_value, fuzzy, proj_name,
+                    page_size=self.lazy_page_size, limit=self.max_results)
+            batch = next(feed)
+            locations.extend(batch.locations)
+        else:
+            for batch in self.api.iter_search(key, query_value, fuzzy,
+                    proj_name, limit=self.max_results):
+                locations.extend(batch.locations)
+        return locations, batch, feed
+
+    def picker_status(self, count, batch, more=False):
+        keys = '~~ [q to quit] ~~ [<return> to select] ~~'
+        if more:
+            return '~~ {} matches so far ({} of {} files). {}'.format(
+                    count, batch.files, batch.total, keys)
+        if batch.partial:
+            return '~~ {} matches (PARTIAL: {} of {} files, see OGrokSetMaxResults). {}'.format(
+                    count, batch.files, batch.total, keys)
+        return '~~ {} matches. {}'.format(count, keys)
+
+    def picker_session(self, handle):
+        with self.pickers_lock:
+            return self.pickers.get(handle)
+
+    @pynvim.autocmd('BufWipeout', pattern='*', eval='expand("<abuf>")')
+    def on_buf_wipeout(self, buf):
+        # <abuf> is the buffer number as a string
+        try:
+            with self.pickers_lock:
+                self.pickers.pop(int(buf), None)
+        except ValueError:
+            pass
+
+    # args: picker buffer
+    # not to be called directly, the lazy picker runs this as you scroll
+    @pynvim.command('OGrokLoadMore', nargs='1', range='')
+    def OGrokLoadMore(self, args, range):
+        try:
+            handle = int(args[0])
+        except ValueError:
+            return
+        self.load_more(handle)
 
+    def load_more(self, handle):
+        session = self.picker_session(handle)
+        if session is None or session.feed is None or session.loading:
+            return
+        session.loading = True
+        buf = self.nvim.buffers[handle]
+        feed = session.feed
 
+        # the request happens off the main thread so scrolling doesn't stall,
+        # then the results are added back on it
+        def fetch():
+            try:
+                batch = next(feed)
+            except Exception as e:
+                self.nvim.async_call(self.lazy_failed, buf, e)
+                return
+            self.nvim.async_call(self.lazy_append, buf, batch)
+        threading.Thread(target=fetch, daemon=True).start()
 
+    def lazy_append(self, buf, batch):
+        session = self.picker_session(buf.handle)
+        # picker was closed while we were fetching
+        if session is None or not buf.valid:
+            return
+        session.loading = False
+
+        locations = batch.locations
+        start = len(session.locations)
+        with self.stats.timed('snippets', n=len(locations)):
+            contents = [l.clean_content() for l in locations]
+        session.locations.extend(locations)
+        session.history_entry['items'].extend(
+            (self.local_path(l), l.line_num, c) for l, c in zip(locations, contents))
+
+        more = not batch.done
+        if not more:
+            session.feed = None
+        lines = self.format_results(locations, contents, session.query_type, start)
+        if more:
+            lines.append(_LAZY_TAIL)
+        status = self.picker_status(len(session.locations), batch, more)
+        with self.stats.timed('render', n=len(lines)):
+            # replaces the placeholder at the end
+            self.nvim.request('nvim_buf_set_lines', buf, -2, -1, True, lines)
+            self.nvim.request('nvim_buf_set_lines', buf, 0, 1, True, [status])
+        self.decorate_results(buf, locations, session.query_type, start)
+
+    def lazy_failed(self, buf, e):
+        self.log.error('load_more_failed', error=str(e))
+        session = self.picker_session(buf.handle)
+        if session is None:
+            return
+        session.loading = False
+        session.feed = None
+        if buf.valid:
+            msg = '~~ failed to load more results: {} ~~'.format(e)
+            self.nvim.request('nvim_buf_set_lines', buf, -2, -1, True, [msg])
+
+
+
+
+
+    # Which results have notes, in one query for the lot: the results go in
+    # a temp table that's joined against AnnotationTable. Returns
+    #    {index in locations: (note, tags)}
+    # or for file searches, which have no lines,
+    #    {index in locations: number of notes in the file}
+    def notes_for_results(self, locations, by_file=False):
+        # realpath once per file, not per hit
+        paths = {}
+        def rows():
+            for i, l in enumerate(locations):
+                path = self.local_path(l)
+                if path not in paths:
+                    paths[path] = self.normalize_path(path)
+                line = None
+                if not by_file:
+                    try:
+                        line = int(l.line_num)
+                    except ValueError:
+                        continue
+                yield (i, paths[path], line)
+
+        self.ensure_annotations()
+        conn = None
+        try:
+            conn = self.annotations_connect()
+            cur = conn.cursor()
+            with self.stats.timed('sql.picker_notes', n=len(locations)):
+                # goes away with the connection
+                cur.execute("CREATE TEMP TABLE OGrokHits(idx INTEGER PRIMARY KEY, file, line)")
+                cur.executemany("INSERT INTO OGrokHits VALUES (?, ?, ?)", rows())
+                if by_file:
+                    data = cur.execute('''SELECT h.idx, COUNT(*) FROM OGrokHits h
+                        JOIN AnnotationTable a ON a.file = h.file GROUP BY h.idx''').fetchall()
+                    return dict(data)
+                data = cur.execute('''SELECT h.idx, a.annotation, a.tags FROM OGrokHits h
+                    JOIN AnnotationTable a ON a.file = h.file AND a.line = h.line''').fetchall()
+                return {i: (note, tags) for i, note, tags in data}
+        finally:
+            if conn:
+                conn.close()
+
+    # markers at the end of the picker lines for results with notes. start
+    # is the index of locations[0] in the picker
+    def decorate_results(self, buf, locations, query_type, start=0):
+        if not self.picker_notes or None == self.annotations_db or len(locations) == 0:
+            return
+        by_file = query_type == 1
+        try:
+            found = self.notes_for_results(locations, by_file)
+        except Exception as e:
+            # the results are still good without them
+            self.log.error('picker_notes_failed', error=str(e))
+            self.nvim.err_write(f'OGrok: Failed to look up notes for results: {e}\n')
+            return
+        marks = []
+        for i, v in sorted(found.items()):
+            if by_file:
+                # the status line, then a line per result
+                marks.append([1 + start + i, '  >> {} note{}'.format(v, '' if v == 1 else 's')])
+            else:
+                note, tags = v
+                text = (note or '').split('\n', 1)[0].strip() or tags
+                # the status line, then 3 lines per result, see format_results
+                marks.append([1 + 3 * (start + i), '  >> ' + text[:60]])
+        if len(marks) > 0:
+            self.nvim.exec_lua(_NOTES_LUA, buf, self.annotation_ns, marks)
+
+    # picker lines for some results. start is the index of the first one.
+    def format_results(self, locations, contents, query_type, start=0):
+        lines = []
+        for i, (l, content) in enumerate(zip(locations, contents), start):
+            if query_type != 1:
+                lines.append('{idx} {path}:{line_num}'.format(idx=i,
+                    path=l.path, line_num=l.line_num))
+                lines.append('        {content}'.format(content=content))
+                lines.append('')
+            else:
+                lines.append('{idx} {path}'.format(idx=i, path=l.path))
+        return lines
 
     @pynvim.command('OGrokGoto', nargs='*', range='')
     def OGrokGoto(self, args, range):
-        if None == self.tmp_saved_locations:
+        session = self.picker_session(self.nvim.current.buffer.handle)
+        if None == session:
             s = "OGrokGoto shouldn't be called directly. "
             s += "If you didn't call directly and are seeing this error "
             s += "then something went wrong."
@@ -1048,43 +2865,34 @@ class OGrokPlugin(object):
             self.nvim.out_write('OGrok: unable to handle selection.\n')
             return
 
-        curr_fpath = self.nvim.request('nvim_buf_get_name', self.tmp_work_buffer)
+        curr_fpath = self.nvim.request('nvim_buf_get_name', session.work_buffer)
         if len(curr_fpath) != 0:
             # if we have a location to save
 
             # save cur location in the tag stack (for the given window)
-            win_id = self.tmp_work_window
-            if win_id in self.marks:
-                self.marks[win_id].append(Mark(curr_fpath, self.tmp_row, self.tmp_col))
-            else:
-                self.marks[win_id] = [Mark(curr_fpath, self.tmp_row, self.tmp_col)]
-            #self.marks.append(Mark(curr_fpath, self.tmp_row, self.tmp_col))
+            win_id = session.work_window.handle
+            self.push_mark(win_id, Mark(curr_fpath, session.row, session.col))
 
         # get next location
-        loc = self.tmp_saved_locations[x]
+        loc = session.locations[x]
 
-        # close menu window+buffer
+        # close menu window+buffer (which drops the session)
         self.nvim.command(':close')
 
         # go to the saved off window
-        self.nvim.request('nvim_set_current_win', self.tmp_work_window)
+        self.nvim.request('nvim_set_current_win', session.work_window)
 
-        # TODO probably need to do more escaping......
-        path = '{}{}'.format(self.path, loc.path)
-        path = path.replace("$", "\\$")
+        path = self.local_path(loc)
+        try:
+            line = int(loc.line_num)
+        except (TypeError, ValueError):
+            line = 0
+        col = -1
+        if line > 0 and session.query_type != 1:
+            line, col = self.correct_line(path, line, loc)
 
         # move that buffer to the location we want
-        cmd = ':e +{line} {path}'.format(
-            path=path,
-            line=loc.line_num
-        )
-        self.nvim.command(cmd)
-
-        self.tmp_saved_locations = None
-        self.tmp_work_buffer = None
-        self.tmp_work_window = None
-        self.tmp_col = None
-        self.tmp_row = None
+        self.jump_to(path, line, col)
         return
 
     @pynvim.command('OGrokDumpStack', nargs='0', range='')
@@ -1094,7 +2902,7 @@ class OGrokPlugin(object):
 
     @pynvim.command('OGrokJumpBack', nargs='0', range='')
     def OGrokJumpBack(self, args, range):
-        win_id = self.nvim.request('nvim_get_current_win')
+        win_id = self.nvim.request('nvim_get_current_win').handle
         if win_id not in self.marks:
             self.nvim.out_write('OGrok: no jump stack for this window.\n')
             return
@@ -1105,7 +2913,343 @@ class OGrokPlugin(object):
                 return
 
             m = stack.pop()
-            # cursor(0, x) stays on current line and jumps to col x
-            cmd = ':e +{line} {path} | call cursor(0,{col})'.format(
-                    line=m.line, path=m.path, col=m.col+1)
-            self.nvim.command(cmd)
+            self.jump_to(m.path, m.line, m.col)
+
+    # The server's index can be behind the local checkout. If the result's
+    # snippet isn't on its line any more, use the nearest line it's on.
+    # Returns (line, col), col is -1 if we don't know.
+    def correct_line(self, path, line, loc):
+        needle, focus = loc.snippet_needles()
+        if len(needle) == 0:
+            return line, -1
+        with self.stats.timed('drift.check'):
+            try:
+                found = self.line_index.find(path, line, needle, focus, self.drift_radius)
+            except (OSError, ValueError) as e:
+                self.log.error('drift_check_failed', file=path, error=str(e))
+                found = None
+        if found is None:
+            return line, -1
+        if found[0] != line:
+            self.log.info('line_drift', file=path, line=line, actual=found[0])
+        return found
+
+    # line is 1 indexed, col is 0 indexed (same as nvim_win_get_cursor)
+    def jump_to(self, path, line, col=0):
+        self.nvim.exec_lua(_JUMP_LUA, path, line, col)
+
+    def push_mark(self, win_id, mark):
+        stack = self.marks.get(win_id)
+        if stack is None:
+            stack = collections.deque(maxlen=self.stack_depth)
+            self.marks[win_id] = stack
+        # oldest mark falls off the left when we're full
+        stack.append(mark)
+
+    @pynvim.autocmd('WinClosed', pattern='*', eval='expand("<amatch>")')
+    def on_win_closed(self, win_id):
+        # <amatch> is the window handle as a string
+        try:
+            self.marks.pop(int(win_id), None)
+        except ValueError:
+            pass
+
+    @pynvim.command('OGrokSetStackDepth', nargs='*', range='', sync=True)
+    def OGrokSetStackDepth(self, args, range):
+        # autocmd VimEnter * OGrokSetStackDepth 50
+        if len(args) < 1:
+            raise Exception("Stack depth required.")
+        try:
+            depth = int(args[0])
+        except Exception as e:
+            raise Exception('OGrok: Failed to set stack depth: {}'.format(e))
+        if depth < 1:
+            raise Exception('OGrok: stack depth must be at least 1.')
+        self.stack_depth = depth
+        for win_id in self.marks:
+            self.marks[win_id] = collections.deque(self.marks[win_id], maxlen=depth)
+
+    @pynvim.command('OGrokSetStackFile', nargs='*', range='', sync=True)
+    def OGrokSetStackFile(self, args, range):
+        # autocmd VimEnter * OGrokSetStackFile ~/.local/share/nvim/ogrok_stack.db
+        if len(args) < 1:
+            raise Exception("Path argument required.")
+        self.stack_db = os.path.expanduser(args[0])
+        self.load_marks()
+
+    # Window handles change between runs so the stacks are stored by tab and
+    # window number, which is usually the same layout if you restore a session.
+    def load_marks(self):
+        import sqlite3
+        conn = None
+        try:
+            conn = sqlite3.connect(self.stack_db)
+            cur = conn.cursor()
+            cur.execute("CREATE TABLE IF NOT EXISTS JumpStackTable(tab, win, idx, path, line, col)")
+            conn.commit()
+            rows = cur.execute("SELECT tab, win, path, line, col FROM JumpStackTable ORDER BY tab, win, idx").fetchall()
+        except Exception as e:
+            self.nvim.err_write(f"OGrok: Failed SQL operation loading jump stack: {e}\n")
+            raise(e)
+        finally:
+            if conn:
+                conn.close()
+
+        handles = {}
+        for tab, win, path, line, col in rows:
+            if (tab, win) not in handles:
+                handles[(tab, win)] = self.nvim.call('win_getid', win, tab)
+            win_id = handles[(tab, win)]
+            if win_id == 0:
+                # no such window any more
+                continue
+            self.push_mark(win_id, Mark(path, line, col))
+
+    def save_marks(self):
+        import sqlite3
+        rows = []
+        for win_id, stack in self.marks.items():
+            tab, win = self.nvim.call('win_id2tabwin', win_id)
+            if tab == 0:
+                continue
+            for idx, m in enumerate(stack):
+                rows.append((tab, win, idx, m.path, m.line, m.col))
+
+        conn = None
+        try:
+            conn = sqlite3.connect(self.stack_db)
+            with conn:
+                cur = conn.cursor()
+                cur.execute("CREATE TABLE IF NOT EXISTS JumpStackTable(tab, win, idx, path, line, col)")
+                cur.execute("DELETE FROM JumpStackTable")
+                cur.executemany("INSERT INTO JumpStackTable (tab, win, idx, path, line, col) VALUES (?, ?, ?, ?, ?, ?)", rows)
+        finally:
+            if conn:
+                conn.close()
+
+    @pynvim.command('OGrokSetHistorySize', nargs='*', range='', sync=True)
+    def OGrokSetHistorySize(self, args, range):
+        # autocmd VimEnter * OGrokSetHistorySize 50
+        if len(args) < 1:
+            raise Exception("Number of searches to keep required.")
+        try:
+            size = int(args[0])
+        except Exception as e:
+            raise Exception('OGrok: Failed to set history size: {}'.format(e))
+        if size < 1:
+            raise Exception('OGrok: history size must be at least 1.')
+        self.history.resize(size)
+
+    @pynvim.command('OGrokSetHistoryFile', nargs='*', range='', sync=True)
+    def OGrokSetHistoryFile(self, args, range):
+        # autocmd VimEnter * OGrokSetHistoryFile ~/.local/share/nvim/ogrok_history.json
+        if len(args) < 1:
+            raise Exception("Path argument required.")
+        try:
+            self.history.load(os.path.expanduser(args[0]))
+        except Exception as e:
+            raise Exception('OGrok: Failed to load history: {}'.format(e))
+
+    @pynvim.autocmd('VimLeavePre', pattern='*', sync=True)
+    def on_vim_leave(self):
+        self.log.close()
+        self.stop_annotation_watcher()
+        try:
+            self.history.save()
+        except Exception as e:
+            self.nvim.err_write('OGrok: Failed to save history: {}\n'.format(e))
+        if self.stack_db:
+            try:
+                self.save_marks()
+            except Exception as e:
+                self.nvim.err_write('OGrok: Failed to save jump stack: {}\n'.format(e))
+
+    @pynvim.command('OGrokHistory', nargs='0', range='', sync=True)
+    def OGrokHistory(self, args, range):
+        if len(self.history.entries) == 0:
+            self.nvim.out_write('OGrok: no search history.\n')
+            return
+        out = []
+        # newest first
+        for i, entry in enumerate(reversed(self.history.entries)):
+            when = time.strftime('%H:%M:%S', time.localtime(entry['time']))
+            out.append('{:3d} {} {} ({} results)'.format(
+                i, when, self.history.title(entry), len(entry['items'])))
+        self.nvim.out_write('\n'.join(out) + '\n')
+
+    # args: [history index], 0 (the default) is the last search
+    @pynvim.command('OGrokQuickfix', nargs='*', range='', sync=True)
+    def OGrokQuickfix(self, args, range):
+        self.export_history(args, False)
+
+    @pynvim.command('OGrokLoclist', nargs='*', range='', sync=True)
+    def OGrokLoclist(self, args, range):
+        self.export_history(args, True)
+
+    def export_history(self, args, loclist):
+        idx = 0
+        if len(args) > 0:
+            try:
+                idx = int(args[0])
+            except ValueError:
+                self.nvim.err_write('OGrok: history index must be an integer.\n')
+                return
+        entry = self.history.get(idx)
+        if None == entry:
+            self.nvim.err_write('OGrok: no search {} in history.\n'.format(idx))
+            return
+        self.set_qf_items(self.history.title(entry), entry['items'], loclist)
+        self.nvim.out_write('OGrok: {} results in {} list.\n'.format(
+            len(entry['items']), 'location' if loclist else 'quickfix'))
+
+    # items is a list of (filename, line, text). One call no matter how many
+    # there are.
+    def set_qf_items(self, title, items, loclist=False):
+        what = {
+            'title' : title,
+            'items' : [{'filename': f, 'lnum': l, 'text': t} for f, l, t in items],
+        }
+        if loclist:
+            self.nvim.call('setloclist', 0, [], ' ', what)
+        else:
+            self.nvim.call('setqflist', [], ' ', what)
+
+    # args: <def|file|sym> [identifiers...]
+    # Without identifiers, looks up every identifier in the given range
+    # (e.g., a visual selection). Results go to the quickfix list.
+    @pynvim.command('OGrokBatch', nargs='*', range='', sync=True)
+    def OGrokBatch(self, args, range):
+        if self.api == None:
+            self.nvim.err_write('OGrok: Cannot query without a server. See OGrokSetServer.\n')
+            return
+        if self.path == None:
+            self.nvim.err_write('OGrok: Cannot query without a base path. See OGrokSetBasePath.\n')
+            return
+        if len(args) < 1 or args[0] not in _QUERY_TYPES:
+            self.nvim.err_write('OGrok: Usage: [range]OGrokBatch <def|file|sym> [identifiers...]\n')
+            return
+
+        key = _QUERY_KEYS[_QUERY_TYPES[args[0]]]
+        if len(args) > 1:
+            terms = args[1:]
+        else:
+            lines = self.nvim.request('nvim_buf_get_lines', 0, range[0] - 1, range[1], False)
+            terms = re.findall(_IDENT_RE, '\n'.join(lines))
+        # dedupe, keep the order they showed up in
+        terms = [t for t in dict.fromkeys(terms) if t not in _BATCH_SKIP]
+        if len(terms) == 0:
+            self.nvim.out_write('OGrok: no identifiers to look up.\n')
+            return
+
+        def lookup(term):
+            locations = []
+            for batch in self.api.iter_search(key, term, limit=self.max_results):
+                locations.extend(batch.locations)
+            return locations
+
+        batch_start = time.perf_counter()
+        results = {}
+        errors = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.batch_workers) as pool:
+            futures = {pool.submit(lookup, t): t for t in terms}
+            for f in concurrent.futures.as_completed(futures):
+                try:
+                    results[futures[f]] = f.result()
+                except Exception as e:
+                    errors.append('{}: {}'.format(futures[f], e))
+
+        # grouped by term, in the order given
+        items = []
+        for t in terms:
+            for l in results.get(t, []):
+                items.append((self.local_path(l), l.line_num,
+                    '[{}] {}'.format(t, l.clean_content())))
+
+        self.stats.add('batch', (time.perf_counter() - batch_start) * 1000.0, terms=len(terms))
+        self.log.info('batch', kind=args[0], terms=len(terms), hits=len(items),
+                errors=len(errors),
+                ms=round((time.perf_counter() - batch_start) * 1000.0, 3))
+        for e in errors:
+            self.nvim.err_write('OGrok: {}.\n'.format(e))
+
+        query = ' '.join(terms)
+        entry = self.history.add('batch ' + args[0], query, False, None, items)
+        self.set_qf_items(self.history.title(entry), items)
+        self.nvim.out_write('OGrok: {} results for {} identifiers in quickfix list.\n'.format(
+            len(items), len(terms)))
+
+    @pynvim.command('OGrokSetBatchWorkers', nargs='*', range='', sync=True)
+    def OGrokSetBatchWorkers(self, args, range):
+        # autocmd VimEnter * OGrokSetBatchWorkers 8
+        if len(args) < 1:
+            raise Exception("Number of concurrent lookups required.")
+        try:
+            self.batch_workers = max(1, int(args[0]))
+        except Exception as e:
+            raise Exception('OGrok: Failed to set batch workers: {}'.format(e))
+
+    # args: symbol [depth]
+    @pynvim.command('OGrokCallTree', nargs='*', range='', sync=True)
+    def OGrokCallTree(self, args, range):
+        if self.api == None:
+            self.nvim.err_write('OGrok: Cannot query without a server. See OGrokSetServer.\n')
+            return
+        if self.path == None:
+            self.nvim.err_write('OGrok: Cannot query without a base path. See OGrokSetBasePath.\n')
+            return
+        if len(args) < 1:
+            self.nvim.err_write('OGrok: Usage: OGrokCallTree <symbol> [depth]\n')
+            return
+        depth = 3
+        if len(args) > 1:
+            try:
+                depth = int(args[1])
+            except ValueError:
+                self.nvim.err_write('OGrok: depth must be an integer.\n')
+                return
+
+        tree = CallTree(self.api, self.local_path, args[0],
+                self.calltree_budget, self.max_results)
+
+        self.nvim.command('botright new')
+        buf = self.nvim.current.buffer
+        for opt, val in [('buftype', 'nofile'), ('bufhidden', 'wipe'), ('swapfile', False)]:
+            self.nvim.request('nvim_buf_set_option', buf, opt, val)
+        self.nvim.command('setlocal shiftwidth=2 foldmethod=indent foldlevel=99 nowrap')
+        header = '~~ callers of {} (depth {}) ~~ [zc/zo to fold] ~~ [gF to jump] ~~'.format(args[0], depth)
+        self.nvim.request('nvim_buf_set_lines', buf, 0, -1, True, [header, args[0] + '  ...'])
+
+        def show(lines, done):
+            if not buf.valid:
+                return
+            tail = [] if done else ['  ...']
+            self.nvim.request('nvim_buf_set_lines', buf, 0, -1, True,
+                    [header] + lines + tail)
+
+        # the lookups happen off the main thread, the buffer is redrawn after
+        # every level
+        def build():
+            tree_start = time.perf_counter()
+            level = [tree.root]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.batch_workers) as pool:
+                for d in range(depth):
+                    if len(level) == 0 or len(tree.memo) >= tree.budget:
+                        break
+                    level = tree.expand(level, pool)
+                    self.nvim.async_call(show, tree.render(depth), False)
+            ms = (time.perf_counter() - tree_start) * 1000.0
+            self.stats.add('calltree', ms, symbols=len(tree.memo))
+            self.log.info('calltree', symbol=tree.root, depth=depth,
+                    symbols=len(tree.memo), ms=round(ms, 3))
+            self.nvim.async_call(show, tree.render(depth), True)
+        threading.Thread(target=build, daemon=True).start()
+
+    @pynvim.command('OGrokSetCallTreeBudget', nargs='*', range='', sync=True)
+    def OGrokSetCallTreeBudget(self, args, range):
+        # autocmd VimEnter * OGrokSetCallTreeBudget 500
+        if len(args) < 1:
+            raise Exception("Number of symbols required.")
+        try:
+            self.calltree_budget = max(1, int(args[0]))
+        except Exception as e:
+            raise Exception('OGrok: Failed to set call tree budget: {}'.format(e))